@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+#!/usr/bin/env python
+
+# Times the stages of loading a group page against the recorded Blizzard
+# responses in benchmarks/fixtures, for a range of roster sizes:
+#
+#   parse      json.loads of the profile and equipment bodies
+#   classify   reducing the json to snapshots (enchants, gems, set pieces)
+#   aggregate  Importer.handle_result filling in toons and the group stats
+#   render     render_rows rendering every row of the grid
+#   load_group the whole page, from the API requests to the finished html
+#
+# The results are written as json. Pass a previous run with --baseline to
+# compare against it; the run exits with status 1 if any stage's median got
+# slower by more than --threshold.
+#
+# python3 benchmarks/bench_groupload.py --output before.json
+# (make changes)
+# python3 benchmarks/bench_groupload.py --baseline before.json
+
+import os
+import sys
+import json
+import time
+import logging
+import platform
+import argparse
+import statistics
+import subprocess
+
+import standins
+
+SIZES = [10, 25, 40, 100]
+STAGES = ['parse', 'classify', 'aggregate', 'render', 'load_group']
+
+class OkResponse(object):
+    status_code = 200
+
+# Returns min/median/mean/max of a stage over repeat runs, in seconds.
+def measure(func, repeat):
+    func()
+    times = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+
+    return {
+        'min': min(times),
+        'median': statistics.median(times),
+        'mean': statistics.mean(times),
+        'max': max(times),
+    }
+
+def run(sizes, repeat, load_repeat):
+    api, mc, groups = standins.install()
+
+    from main import app
+    import wowapi
+    import characters
+    import grouploader
+
+    refdata = wowapi.get_reference_data()
+    classes = refdata.class_names
+    realm = api.roster['realm']
+    frealm = api.roster['frealm']
+
+    results = []
+    for size in sizes:
+        toons = api.make_roster(size)
+        group = grouploader.Groupv2(nrealm=realm, ngroup='benchmark%d' % size,
+                                    groupname='Benchmark %d' % size, password='')
+        group.toons = [grouploader.Toonv2(**t) for t in toons]
+        groups.put(group)
+
+        # A stand-in that no longer matches the app turns every toon into
+        # an error row, which would look like a big speedup.
+        check = []
+        wowapi.Importer().load(realm, frealm, group.toons, check, grouploader.new_groupstats(), refdata)
+        failed = [c.name for c in check if c.load_status != 'ok']
+        if failed:
+            raise RuntimeError('toons failed to load from the fixtures: %s' % ', '.join(failed))
+
+        bodies = [api.bodies[t['name'].lower()] for t in toons]
+        parsed = [(json.loads(p), json.loads(e)) for p, e in bodies]
+        compact = [(characters.parse_profile(p), characters.parse_equipment(e)) for p, e in parsed]
+
+        def parse():
+            for profile, equipment in bodies:
+                json.loads(profile)
+                json.loads(equipment)
+
+        def classify():
+            for profile, equipment in parsed:
+                characters.parse_profile(profile)
+                characters.parse_equipment(equipment)
+
+        snapshots = []
+        def aggregate():
+            importer = wowapi.Importer()
+            groupstats = grouploader.new_groupstats()
+            del snapshots[:]
+            for toon, (profile, items) in zip(group.toons, compact):
+                snapshot = characters.CharacterSnapshot(toon.name, realm, frealm, toon.status, toon.role)
+                importer.handle_result(OkResponse(), profile, OkResponse(), items,
+                                       snapshot, groupstats, classes)
+                snapshots.append(snapshot)
+
+        def render():
+            grouploader.render_rows(snapshots, realm)
+
+        def load_group():
+            grouploader.load_group(group)
+
+        stages = {
+            'parse': (parse, repeat),
+            'classify': (classify, repeat),
+            'aggregate': (aggregate, repeat),
+            'render': (render, repeat),
+            'load_group': (load_group, load_repeat),
+        }
+
+        with app.test_request_context('/%s/%s' % (realm, group.ngroup)):
+            for stage in STAGES:
+                func, count = stages[stage]
+                timing = measure(func, count)
+                timing.update(stage=stage, toons=size, repeat=count)
+                results.append(timing)
+                print('%-10s %4d toons  median %9.3f ms  min %9.3f ms' % (
+                    stage, size, timing['median'] * 1000, timing['min'] * 1000), file=sys.stderr)
+
+    return results
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       cwd=os.path.split(__file__)[0] or '.',
+                                       stderr=subprocess.DEVNULL).decode('utf-8').strip()
+    except Exception:
+        return None
+
+# Compares the medians of a run against a baseline run. Returns the list of
+# stages that regressed by more than threshold.
+def compare(results, baseline, threshold):
+    base = dict(((r['stage'], r['toons']), r) for r in baseline['results'])
+    regressions = []
+
+    print('\n%-10s %5s %12s %12s %8s' % ('stage', 'toons', 'baseline ms', 'current ms', 'change'), file=sys.stderr)
+    for result in results:
+        old = base.get((result['stage'], result['toons']))
+        if old is None:
+            continue
+
+        change = result['median'] / old['median'] - 1.0
+        flag = ''
+        if change > threshold:
+            flag = '  REGRESSION'
+            regressions.append(result)
+
+        print('%-10s %5d %12.3f %12.3f %+7.1f%%%s' % (
+            result['stage'], result['toons'], old['median'] * 1000, result['median'] * 1000,
+            change * 100, flag), file=sys.stderr)
+
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the group page load path')
+    parser.add_argument('--sizes', type=int, nargs='+', default=SIZES,
+                        help='roster sizes to time')
+    parser.add_argument('--repeat', type=int, default=50,
+                        help='runs per measurement for the individual stages')
+    parser.add_argument('--load-repeat', type=int, default=10,
+                        help='runs per measurement for the full load_group')
+    parser.add_argument('--output', help='write the results to this file instead of stdout')
+    parser.add_argument('--baseline', help='results from a previous run to compare against')
+    parser.add_argument('--threshold', type=float, default=0.10,
+                        help='fractional slowdown of a median that counts as a regression')
+    args = parser.parse_args()
+
+    # The app logs a line or two for every toon, which would be timed along
+    # with everything else.
+    logging.disable(logging.WARNING)
+
+    results = run(args.sizes, args.repeat, args.load_repeat)
+    output = {
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'created': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'results': results,
+    }
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(output, f, indent=2)
+            f.write('\n')
+    else:
+        json.dump(output, sys.stdout, indent=2)
+        sys.stdout.write('\n')
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if compare(results, baseline, args.threshold):
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+#!/usr/bin/env python
+
+# Records the profile and equipment responses for a roster from the live
+# Blizzard API into benchmarks/fixtures, replacing what's there. This needs
+# the same api-auth.json as the app. Each toon is given as name:role:status,
+# for example:
+#
+# python3 benchmarks/record_fixtures.py aerie-peak "Aerie Peak" Tankadin:tank:main Frostbyte:ranged:main
+
+import os
+import sys
+import json
+import urllib
+import argparse
+
+import standins
+
+def main():
+    parser = argparse.ArgumentParser(description='Record Blizzard API responses for the benchmarks')
+    parser.add_argument('realm', help='realm slug, like aerie-peak')
+    parser.add_argument('frealm', help='full realm name, like "Aerie Peak"')
+    parser.add_argument('toons', nargs='+', help='name:role:status for each toon')
+    parser.add_argument('--output', default=standins.FIXTURE_DIR)
+    args = parser.parse_args()
+
+    sys.path.insert(0, os.path.join(os.path.split(__file__)[0], '..'))
+    import wowapi
+    import ratelimit
+
+    # The token and the rate limit counters normally live in memcache.
+    mc = standins.MemoryMemcache()
+    wowapi.memcache = mc
+    ratelimit.memcache = mc
+
+    client = wowapi.ApiClient()
+    headers = client.oauth_headers()
+
+    roster = []
+    for entry in args.toons:
+        name, role, status = entry.split(':')
+        quoted_name = urllib.parse.quote(name.encode('utf-8').lower())
+        url = f'https://us.api.blizzard.com/profile/wow/character/{args.realm}/{quoted_name}?namespace=profile-us&locale=en_US'
+
+        profile = client.get(url, headers)
+        if profile.status_code != 200:
+            print('failed to load the profile for %s: %d' % (name, profile.status_code), file=sys.stderr)
+            continue
+        profile = profile.json()
+
+        equipment = client.get(profile['equipment']['href'] + '&locale=en_US', headers)
+        if equipment.status_code != 200:
+            print('failed to load the equipment for %s: %d' % (name, equipment.status_code), file=sys.stderr)
+            continue
+        equipment = equipment.json()
+
+        base = os.path.join(args.output, name.lower())
+        with open(base + '.profile.json', 'w') as f:
+            json.dump(profile, f, indent=2, sort_keys=True)
+        with open(base + '.equipment.json', 'w') as f:
+            json.dump(equipment, f, indent=2, sort_keys=True)
+
+        roster.append({'name': profile['name'], 'realm': args.realm, 'role': role, 'status': status})
+        print('recorded %s' % profile['name'], file=sys.stderr)
+
+    with open(os.path.join(args.output, 'roster.json'), 'w') as f:
+        json.dump({'realm': args.realm, 'frealm': args.frealm, 'toons': roster}, f, indent=2)
+        f.write('\n')
+
+if __name__ == '__main__':
+    main()
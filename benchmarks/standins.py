@@ -0,0 +1,279 @@
+# -*- coding: utf-8 -*-
+#!/usr/bin/env python
+
+# In-memory stand-ins for the App Engine services and the Blizzard API, so the
+# group-load path can be timed on a laptop without a datastore, memcache, or
+# network. Everything here is installed by monkeypatching the app's modules,
+# and none of it is deployed.
+
+import os
+import sys
+import json
+import time
+import threading
+
+import requests
+from google.appengine.ext import ndb
+
+FIXTURE_DIR = os.path.join(os.path.split(__file__)[0], 'fixtures')
+
+# Dict-backed memcache with the subset of the API the app uses. Expiration
+# times are accepted and ignored.
+class MemoryMemcache(object):
+
+    STORED = 1
+    NOT_STORED = 2
+
+    def __init__(self):
+        self.data = {}
+        self.lock = threading.RLock()
+
+        # Bumped on every write to a key, for gets and cas.
+        self.versions = {}
+        self.seen = {}
+
+    def changed(self, key):
+        self.versions[key] = self.versions.get(key, 0) + 1
+
+    def get(self, key, namespace=None):
+        return self.data.get(key)
+
+    def get_multi(self, keys, key_prefix='', namespace=None, for_cas=False):
+        with self.lock:
+            if for_cas:
+                for k in keys:
+                    self.seen[key_prefix + k] = self.versions.get(key_prefix + k, 0)
+            return dict((k, self.data[key_prefix + k]) for k in keys if key_prefix + k in self.data)
+
+    def set(self, key, value, time=0, namespace=None):
+        with self.lock:
+            self.data[key] = value
+            self.changed(key)
+            return True
+
+    def set_multi(self, mapping, key_prefix='', time=0, namespace=None):
+        for k, v in mapping.items():
+            self.set(key_prefix + k, v)
+        return []
+
+    def add(self, key, value, time=0, namespace=None):
+        with self.lock:
+            if key in self.data:
+                return False
+            return self.set(key, value)
+
+    def delete(self, key, namespace=None):
+        with self.lock:
+            self.data.pop(key, None)
+            self.changed(key)
+            return 2
+
+    def delete_multi(self, keys, key_prefix='', namespace=None):
+        for k in keys:
+            self.delete(key_prefix + k)
+        return True
+
+    def incr(self, key, delta=1, namespace=None, initial_value=None):
+        with self.lock:
+            if key not in self.data:
+                if initial_value is None:
+                    return None
+                self.data[key] = initial_value
+            self.data[key] += delta
+            self.changed(key)
+            return self.data[key]
+
+    def offset_multi(self, mapping, key_prefix='', namespace=None, initial_value=None):
+        return dict((k, self.incr(key_prefix + k, v, initial_value=initial_value))
+                    for k, v in mapping.items())
+
+    # The app only uses memcache.Client() for gets and cas, and one client
+    # tracking what it has seen is enough for that here.
+    def Client(self):
+        return self
+
+    def gets(self, key, namespace=None):
+        with self.lock:
+            self.seen[key] = self.versions.get(key, 0)
+            return self.data.get(key)
+
+    def cas(self, key, value, time=0, namespace=None):
+        with self.lock:
+            if key not in self.data or self.seen.pop(key, None) != self.versions.get(key, 0):
+                return False
+            return self.set(key, value)
+
+    def cas_multi(self, mapping, time=0, key_prefix='', namespace=None):
+        return [k for k, v in mapping.items() if not self.cas(key_prefix + k, v)]
+
+    # The async calls run right away and hand back something with the
+    # get_result() of the RPC.
+    def offset_multi_async(self, mapping, key_prefix='', namespace=None, initial_value=None):
+        return Done(self.offset_multi(mapping, key_prefix, initial_value=initial_value))
+
+    def set_multi_async(self, mapping, key_prefix='', time=0, namespace=None):
+        self.set_multi(mapping, key_prefix)
+        return Done(dict((k, self.STORED) for k in mapping))
+
+    def add_multi_async(self, mapping, key_prefix='', time=0, namespace=None):
+        return Done(dict((k, self.STORED if self.add(key_prefix + k, v) else self.NOT_STORED)
+                         for k, v in mapping.items()))
+
+class Done(object):
+
+    def __init__(self, result):
+        self.result = result
+
+    def get_result(self):
+        return self.result
+
+# Stands in for the datastore-backed group lookups.
+class MemoryGroups(object):
+
+    def __init__(self):
+        self.groups = {}
+
+    def query_group(self, nrealm, ngroup):
+        return self.groups.get((nrealm, ngroup))
+
+    def put(self, group):
+        if group.key is None:
+            group.key = ndb.Key('Groupv2', len(self.groups) + 1)
+        self.groups[(group.nrealm, group.ngroup)] = group
+
+    # Stands in for visits.write_visits, which needs a datastore transaction.
+    def write_visits(self, batch):
+        written = []
+        for key, visited, count in batch:
+            for group in self.groups.values():
+                if group.key == key:
+                    if visited is not None and (group.lastvisited is None or group.lastvisited < visited):
+                        group.lastvisited = visited
+                    group.visits = (group.visits or 0) + count
+                    written.append(group)
+        return written
+
+    # Stands in for Groupv2.query(...).order(...). The filters are ignored,
+    # and every group that has been visited is returned, most recent first.
+    def query(self, *filters):
+        return self
+
+    def order(self, *orders):
+        return self
+
+    def fetch(self):
+        visited = [g for g in self.groups.values() if g.lastvisited is not None]
+        return sorted(visited, key=lambda g: g.lastvisited, reverse=True)
+
+# Serves the recorded profile and equipment responses. A roster bigger than
+# the recorded one is built by cloning the recorded toons under new names, so
+# every toon in the group still gets its own URLs and its own response bodies.
+class FixtureApi(object):
+
+    def __init__(self, fixture_dir=FIXTURE_DIR):
+        with open(os.path.join(fixture_dir, 'roster.json')) as f:
+            self.roster = json.load(f)
+
+        self.recorded = []
+        for toon in self.roster['toons']:
+            base = os.path.join(fixture_dir, toon['name'].lower())
+            with open(base + '.profile.json') as f:
+                profile = json.load(f)
+            with open(base + '.equipment.json') as f:
+                equipment = json.load(f)
+            self.recorded.append((toon, profile, equipment))
+
+        # lowercased name -> (profile body, equipment body)
+        self.bodies = {}
+
+        # lowercased name -> status code to answer with instead of the
+        # recorded responses, for testing failed loads
+        self.errors = {}
+
+        # The number of calls answered
+        self.calls = 0
+
+    # Returns a list of roster entries for a group of count toons, and
+    # registers the response bodies for them.
+    def make_roster(self, count):
+        toons = []
+        for idx in range(count):
+            toon, profile, equipment = self.recorded[idx % len(self.recorded)]
+            clone = idx // len(self.recorded)
+            name = toon['name'] + (''.join(chr(ord('a') + int(c)) for c in str(clone)) if clone else '')
+            toons.append(dict(toon, name=name))
+
+            lname = name.lower()
+            if lname in self.bodies:
+                continue
+
+            profile = json.loads(json.dumps(profile))
+            profile['name'] = name
+            profile['name_search'] = lname
+            profile['equipment']['href'] = profile['equipment']['href'].replace(
+                '/%s/' % toon['name'].lower(), '/%s/' % lname)
+
+            # The API sends compact json, so the bodies are re-serialized
+            # that way regardless of how the fixtures are formatted.
+            self.bodies[lname] = (json.dumps(profile, separators=(',', ':')).encode('utf-8'),
+                                  json.dumps(equipment, separators=(',', ':')).encode('utf-8'))
+        return toons
+
+    def response(self, url):
+        response = requests.Response()
+        response.url = url
+        response.headers['Content-Type'] = 'application/json;charset=UTF-8'
+
+        self.calls += 1
+        lname = requests.utils.unquote(url.split('/character/')[1].split('/')[1].split('?')[0])
+        bodies = self.bodies.get(lname)
+        if lname in self.errors:
+            response.status_code = self.errors[lname]
+            response._content = b'{"code":%d,"type":"BLZWEBAPI00000%d","detail":"Error"}' % (
+                self.errors[lname], self.errors[lname])
+        elif bodies is None:
+            response.status_code = 404
+            response._content = b'{"code":404,"type":"BLZWEBAPI00000404","detail":"Not Found"}'
+        else:
+            response.status_code = 200
+            response._content = bodies[1] if '/equipment' in url else bodies[0]
+        return response
+
+# Patches the app's modules to use the stand-ins. Returns the FixtureApi, the
+# memcache, and the group store.
+def install(fixture_dir=FIXTURE_DIR):
+    sys.path.insert(0, os.path.join(os.path.split(__file__)[0], '..'))
+
+    import wowapi
+    import ratelimit
+    import grouploader
+    import pagecache
+    import visits
+
+    mc = MemoryMemcache()
+    for module in (wowapi, ratelimit, grouploader, pagecache, visits):
+        module.memcache = mc
+
+    api = FixtureApi(fixture_dir)
+    def get(self, url, headers, started=None):
+        if started is not None:
+            started()
+        return api.response(url)
+    wowapi.ApiClient.get = get
+    wowapi.TokenManager.request_token = lambda self: ('benchmark', time.time() + 86400)
+
+    # The benchmark measures the app, not Blizzard's rate limits.
+    ratelimit.limiter = ratelimit.RateLimiter(per_second=10**9, per_hour=10**12)
+
+    refdata = wowapi.ReferenceData(1, [wowapi.RealmInfo(api.roster['realm'], api.roster['frealm'])],
+                                   dict((p['character_class']['id'], p['character_class']['name'])
+                                        for _, p, _ in api.recorded))
+    wowapi.get_reference_data = lambda: refdata
+
+    groups = MemoryGroups()
+    grouploader.Groupv2.query_group = classmethod(lambda cls, nrealm, ngroup: groups.query_group(nrealm, ngroup))
+    grouploader.Groupv2.put = lambda self: groups.put(self)
+    grouploader.Groupv2.query = classmethod(lambda cls, *filters: groups.query(*filters))
+    visits.write_visits = groups.write_visits
+
+    return api, mc, groups
@@ -0,0 +1,260 @@
+# -*- coding: utf-8 -*-
+#!/usr/bin/env python
+
+import hashlib
+
+import gearrules
+
+# The equipment slots shown on the grid, in the order they're stored in a
+# CharacterSnapshot.
+SLOTS = ('head', 'shoulder', 'chest', 'hands', 'legs', 'feet', 'neck',
+         'back', 'wrist', 'waist', 'finger_1', 'finger_2', 'trinket_1',
+         'trinket_2', 'main_hand', 'off_hand')
+SLOT_INDEX = dict((slot, idx) for idx, slot in enumerate(SLOTS))
+
+# Version of the snapshots kept in the character cache. The grid's styles and
+# the enchant checks are worked out when the equipment is parsed, so this
+# changes along with the rules for them, and snapshots from before a change
+# aren't used.
+SNAPSHOT_VERSION = hashlib.sha1(repr((
+    3, gearrules.rules.version, gearrules.MIN_NORMAL, gearrules.MIN_HEROIC,
+    gearrules.MIN_MYTHIC, gearrules.COLOR_LFR, gearrules.COLOR_NORMAL,
+    gearrules.COLOR_HEROIC, gearrules.COLOR_MYTHIC, gearrules.COLOR_LEGENDARY,
+)).encode('utf-8')).hexdigest()[:8]
+
+# Returns the style for an item's cell on the grid: a background color for
+# the ilvl, and a border if the item is missing an enchant or has a lesser
+# one.
+def item_style(level, quality, enchant):
+    style = ''
+    if quality == 'LEGENDARY':
+        style = 'background-color:' + gearrules.COLOR_LEGENDARY
+    elif level > 0 and level < gearrules.MIN_NORMAL:
+        style = 'background-color:' + gearrules.COLOR_LFR
+    elif level >= gearrules.MIN_NORMAL and level < gearrules.MIN_HEROIC:
+        style = 'background-color:' + gearrules.COLOR_NORMAL
+    elif level >= gearrules.MIN_HEROIC and level < gearrules.MIN_MYTHIC:
+        style = 'background-color:' + gearrules.COLOR_HEROIC
+    elif level >= gearrules.MIN_MYTHIC:
+        style = 'background-color:' + gearrules.COLOR_MYTHIC
+
+    if enchant == gearrules.ENCHANT_MISSING:
+        style += ';border: 1px solid red'
+    elif enchant == gearrules.ENCHANT_LESSER:
+        style += ';border: 1px solid blue'
+    return style
+
+# Returns the parameters for an item's wowhead link, so the tooltip shows the
+# item with the toon's bonuses, enchant and gems.
+def wowhead_rel(bonus_lists, enchant_id, gems):
+    rel_entries = []
+
+    if bonus_lists:
+        rel_entries.append('bonus=%s' % ':'.join(map(str, bonus_lists)))
+
+    if enchant_id:
+        rel_entries.append('ench=%s' % enchant_id)
+
+    if gems:
+        rel_entries.append('gems=%s' % gems)
+
+    return '&'.join(rel_entries)
+
+# The parts of an equipped item that the grid uses, along with the style and
+# wowhead parameters for its cell.
+class ItemSnapshot(object):
+    __slots__ = ('id', 'level', 'quality', 'enchant', 'enchant_id', 'gems',
+                 'set', 'bonus_lists', 'two_handed', 'style', 'rel')
+
+    def __init__(self, id=0, level=0, quality='', enchant=gearrules.ENCHANT_NONE,
+                 enchant_id=0, gems='', set='no', bonus_lists=(), two_handed=False):
+        self.id = id
+        self.level = level
+        self.quality = quality
+
+        # How well the item is enchanted (one of the gearrules.ENCHANT_*
+        # values), and the permanent enchant on it if there is one
+        self.enchant = enchant
+        self.enchant_id = enchant_id
+
+        # The ids of the gems in the item, joined with ':' like wowhead wants
+        self.gems = gems
+
+        # 'tier', 'crafted', or 'no'
+        self.set = set
+        self.bonus_lists = bonus_lists
+        self.two_handed = two_handed
+
+        self.style = item_style(level, quality, enchant)
+        self.rel = wowhead_rel(bonus_lists, enchant_id, gems)
+
+# Stands in for the items in empty slots.
+EMPTY_ITEM = ItemSnapshot()
+
+# Pulls the fields the page uses out of the json from the character profile
+# API.
+def parse_profile(jsondata):
+    return {
+        'name': jsondata['name'],
+        'realm': jsondata.get('realm', {}).get('name', ''),
+        'guild': jsondata.get('guild', {}).get('name'),
+        'character_class': jsondata['character_class']['name'],
+        'average_item_level': jsondata['average_item_level'],
+        'equipped_item_level': jsondata['equipped_item_level'],
+        'equipment_href': jsondata.get('equipment', {}).get('href'),
+    }
+
+# Converts the json from the character equipment API into a list with an
+# ItemSnapshot (or None) for each of the grid's slots. Things like shirts and
+# tabards are ignored.
+def parse_equipment(jsondata):
+    items = [None] * len(SLOTS)
+
+    for item in jsondata.get('equipped_items', []):
+        if not isinstance(item, dict):
+            continue
+
+        slot = item.get('slot', {}).get('type', '')
+        idx = SLOT_INDEX.get(slot.lower())
+        if idx is None:
+            continue
+
+        # Group all gems together into a colon-separated list for the
+        # tooltip parameters
+        gems = ':'.join(str(socket.get('item', {}).get('id', 0)) for socket in item.get('sockets', []))
+
+        # Default enchant checking to none for all items
+        enchant = gearrules.ENCHANT_NONE
+        enchant_id = 0
+        if slot in gearrules.rules.enchant_slots:
+            if slot != 'OFF_HAND' or 'weapon' in item:
+                enchant = gearrules.ENCHANT_MISSING
+                for entry in item.get('enchantments', []):
+
+                    # Skip non-permanent enchants
+                    if entry.get('enchantment_slot', {}).get('id', -1) != 0:
+                        continue
+
+                    enchant_id = entry.get('enchantment_id', 0)
+                    enchant = max(enchant, gearrules.rules.enchant_rank(slot, enchant_id))
+
+        items[idx] = ItemSnapshot(
+            id=item['item']['id'],
+            level=item['level']['value'],
+            quality=item['quality']['type'],
+            enchant=enchant,
+            enchant_id=enchant_id,
+            gems=gems,
+            set=gearrules.rules.set_type(item),
+            bonus_lists=tuple(item.get('bonus_list', [])),
+            two_handed=item.get('inventory_type', {}).get('type') == 'TWOHWEAPON')
+
+    return items
+
+# Everything the page needs to know about one toon in a group: the toon's
+# entry in the roster, plus the data loaded for it from the Blizzard API or
+# the reason that failed.
+class CharacterSnapshot(object):
+    __slots__ = ('name', 'toonrealm', 'toonfrealm', 'status', 'role',
+                 'load_status', 'reason', 'realm', 'guild', 'character_class',
+                 'average_item_level', 'equipped_item_level', 'items',
+                 'avgilvl', 'tiercount', 'as_of', 'missing')
+
+    def __init__(self, name, toonrealm, toonfrealm, status, role):
+        self.name = name
+
+        # The normalized realm and the full realm name from the roster. The
+        # realm name sent by the API is stored separately in realm.
+        self.toonrealm = toonrealm
+        self.toonfrealm = toonfrealm
+        self.status = status
+        self.role = role
+
+        self.load_status = 'ok'
+        self.reason = None
+
+        self.realm = None
+        self.guild = None
+        self.character_class = None
+        self.average_item_level = 0
+        self.equipped_item_level = 0
+
+        # An ItemSnapshot or None for each of the SLOTS, or None if the
+        # equipment wasn't loaded
+        self.items = None
+
+        # The average ilvl of the equipped items, counting a two-hander
+        # twice, and the number of tier pieces
+        self.avgilvl = None
+        self.tiercount = 0
+
+        # When the data was loaded, if it's an older copy instead of what the
+        # API returned for this page view
+        self.as_of = None
+
+        # Whether Blizzard said the toon doesn't exist, as opposed to the
+        # load failing in a way that might work next time
+        self.missing = False
+
+    def fail(self, reason, missing=False):
+        self.load_status = 'nok'
+        self.reason = reason
+        self.missing = missing
+
+    def set_profile(self, profile):
+        self.name = profile['name']
+        self.realm = profile['realm']
+        self.guild = profile['guild']
+        self.character_class = profile['character_class']
+        self.average_item_level = profile['average_item_level']
+        self.equipped_item_level = profile['equipped_item_level']
+
+    def set_items(self, items):
+        self.items = items
+
+        total = 0
+        count = 0
+        self.tiercount = 0
+        for item in items:
+            if item is None:
+                continue
+            total += item.level
+            count += 1
+            if item.set == 'tier':
+                self.tiercount += 1
+
+        # if there's no offhand and the main hand is a two-hander, count it double per Blizzard
+        # ilvl formulas. This breaks for classes like Fury that can normally one-hand wield
+        # two-handers, but that's life.
+        main_hand = items[SLOT_INDEX['main_hand']]
+        if main_hand is not None and main_hand.two_handed and items[SLOT_INDEX['off_hand']] is None:
+            total += main_hand.level
+            count += 1
+
+        if count != 0:
+            self.avgilvl = round(float(total)/float(count), 1)
+
+    # Fills in the snapshot from an older copy of the toon's profile and
+    # items, loaded at the time as_of.
+    def restore(self, profile, items, as_of):
+        self.load_status = 'ok'
+        self.reason = None
+        self.set_profile(profile)
+        self.set_items(items)
+        self.as_of = as_of
+
+    # Returns a copy of the snapshot for another roster entry for the same
+    # toon, which may have a different status and role.
+    def with_roster(self, status, role):
+        copy = CharacterSnapshot.__new__(CharacterSnapshot)
+        for field in CharacterSnapshot.__slots__:
+            setattr(copy, field, getattr(self, field))
+        copy.status = status
+        copy.role = role
+        return copy
+
+    # Returns the item in a slot, or EMPTY_ITEM if there isn't one.
+    def item(self, slot):
+        if self.items is None:
+            return EMPTY_ITEM
+        return self.items[SLOT_INDEX[slot]] or EMPTY_ITEM
@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+#!/usr/bin/env python
+
+import os
+import hmac
+import hashlib
+import logging
+import threading
+
+from itsdangerous import URLSafeTimedSerializer, BadSignature
+from google.appengine.ext import ndb
+from google.appengine.api import memcache
+
+# How long, in seconds, an edit session token is good for.
+EDIT_SESSION_TIME = 30 * 60
+
+# Tokens for skipping the password hash while editing a group. Checking a
+# password against the sha256_crypt hash stored with a group takes a lot of
+# CPU on purpose, and the editor checks it with /val and then again when the
+# group is saved. Once a password has been checked, /val hands back a signed
+# token that names the group and carries a keyed hash of the password, and
+# later checks in the same editing session compare against that instead. The
+# token also carries a hash of the group's stored password hash, so it stops
+# working if the password changes.
+#
+# The signing key is made once and kept in the datastore, so every instance
+# signs with the same one. Instances keep it in memory once they've loaded it,
+# with memcache in between.
+
+SECRET_KEY = 'edit_session_secret'
+
+class EditSecret(ndb.Model):
+    secret = ndb.StringProperty(indexed=False)
+
+_secret = None
+_secret_lock = threading.Lock()
+
+def get_secret():
+    global _secret
+
+    with _secret_lock:
+        if _secret is None:
+            secret = memcache.get(SECRET_KEY)
+            if secret is None:
+                # get_or_insert is transactional, so if two instances get
+                # here at once they still end up with the same key.
+                entry = EditSecret.get_or_insert('edit-session', secret=os.urandom(32).hex())
+                secret = entry.secret
+                memcache.set(SECRET_KEY, secret)
+            _secret = secret
+        return _secret
+
+def serializer():
+    return URLSafeTimedSerializer(get_secret(), salt='edit-session')
+
+def password_mac(password):
+    return hmac.new(get_secret().encode('utf-8'), password.encode('utf-8'), hashlib.sha256).hexdigest()
+
+def hash_fingerprint(group):
+    return hashlib.sha256((group.password or '').encode('utf-8')).hexdigest()[:16]
+
+# Returns a token for a group whose password was just checked.
+def issue(group, password):
+    return serializer().dumps({
+        'realm': group.nrealm,
+        'group': group.ngroup,
+        'hash': hash_fingerprint(group),
+        'pw': password_mac(password),
+    })
+
+# Returns whether a token is good for a group and the password sent with it.
+def check(token, group, password):
+    try:
+        data = serializer().loads(token, max_age=EDIT_SESSION_TIME)
+    except BadSignature:
+        logging.info('edit session token for %s/%s was invalid or expired' % (group.nrealm, group.ngroup))
+        return False
+
+    return (data.get('realm') == group.nrealm and data.get('group') == group.ngroup and
+            data.get('hash') == hash_fingerprint(group) and
+            hmac.compare_digest(data.get('pw', ''), password_mac(password)))
@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+#!/usr/bin/env python
+
+import os
+import json
+
+# Values for how well an item is enchanted, as shown on the grid. Items in
+# slots that don't take an enchant are ENCHANT_NONE.
+ENCHANT_NONE = -1
+ENCHANT_MISSING = 0
+ENCHANT_LESSER = 1
+ENCHANT_BETTER = 2
+
+# Minimum ilvls and colors for the ilvl grid
+MIN_NORMAL = 684
+MIN_HEROIC = 697
+MIN_MYTHIC = 710
+COLOR_LFR = '#FFB2B2'
+COLOR_NORMAL = '#FFFFB2'
+COLOR_HEROIC = '#B2FFB2'
+COLOR_MYTHIC = '#C3BEFF'
+COLOR_LEGENDARY = '#FFCA68'
+
+RULES_PATH = os.path.join(os.path.split(__file__)[0], 'gear_rules.json')
+
+# The rules for auditing gear, compiled into lookup tables from the data in
+# gear_rules.json. The data file lists each enchant with its rank, grouped by
+# the kind of item it goes on, along with which slots take which groups. The
+# enchant spell numbers don't come from wowhead, but from the game data itself.
+# When a new season changes them, regenerate the data file with
+# tools/parse_permanent_enchant.py.
+class GearRules(object):
+
+    def __init__(self, rules):
+        self.version = rules['version']
+
+        # (slot, enchant id) -> ENCHANT_LESSER or ENCHANT_BETTER. Enchants at
+        # or above the better rank count as better enchants. If an enchant
+        # is listed at more than one rank, the best one wins.
+        self.enchant_ranks = {}
+        better_rank = rules['better_rank']
+        for slot, groups in rules['slots'].items():
+            for group in groups:
+                for enchant in rules['enchants'][group]:
+                    if enchant['rank'] >= better_rank:
+                        value = ENCHANT_BETTER
+                    else:
+                        value = ENCHANT_LESSER
+                    key = (slot, enchant['id'])
+                    self.enchant_ranks[key] = max(value, self.enchant_ranks.get(key, value))
+
+        # Slots that should have an enchant on them
+        self.enchant_slots = frozenset(rules['slots'].keys())
+
+        self.tier_sets = frozenset(rules['tier_sets'])
+        self.crafted_limit_categories = frozenset(rules['crafted_limit_categories'])
+
+    @classmethod
+    def load(cls, path=RULES_PATH):
+        with open(path) as rules_file:
+            return cls(json.load(rules_file))
+
+    # Returns ENCHANT_LESSER or ENCHANT_BETTER for a known enchant on an item
+    # in a slot, and ENCHANT_MISSING for anything else.
+    def enchant_rank(self, slot, enchant_id):
+        return self.enchant_ranks.get((slot, enchant_id), ENCHANT_MISSING)
+
+    # Returns whether an item from the equipment API is 'crafted', 'tier', or
+    # neither ('no').
+    def set_type(self, item):
+        # TODO: how do crafted rings/necks show up here? They don't have a profession
+        # requirement to wear them.
+        if 'profession' in item.get('requirements', {}).get('skill', {}):
+            return 'crafted'
+        elif item.get('limit_category', '') in self.crafted_limit_categories:
+            return 'crafted'
+        elif item.get('set', {}).get('item_set', {}).get('id', 0) in self.tier_sets:
+            return 'tier'
+        return 'no'
+
+rules = GearRules.load()
@@ -2,25 +2,57 @@
 #!/usr/bin/env python
 
 import json
+import time
 import logging
+import threading
 from datetime import datetime
 
-from flask import render_template, redirect
+from flask import render_template, redirect, Response, stream_with_context, copy_current_request_context
 import wowapi
+import metrics
+import characters
+import editsession
+import gearrules
+import pagecache
+import visits
 
 from google.appengine.ext import ndb
 from google.appengine.api import memcache
 from passlib.hash import sha256_crypt
 
-# Minimum ilvls and colors for the ilvl grid
-MIN_NORMAL = 684
-MIN_HEROIC = 697
-MIN_MYTHIC = 710
-COLOR_LFR = '#FFB2B2'
-COLOR_NORMAL = '#FFFFB2'
-COLOR_HEROIC = '#B2FFB2'
-COLOR_MYTHIC = '#C3BEFF'
-COLOR_LEGENDARY = '#FFCA68'
+# Whether group pages are streamed to the browser by default, sending each
+# character's row as soon as it loads instead of the whole page at the end.
+# Can be overridden per request with ?stream=0/1. Note that App Engine standard
+# buffers the whole response before sending it, so this only helps when
+# running somewhere that passes streamed responses through.
+STREAM_GROUP_PAGES = False
+
+# Whether group pages are sent without the characters' rows, which the browser
+# then loads from /row in parallel. A row only depends on the toon and its
+# role and status, so it can be cached at the edge and shared by every group
+# the toon is in. Can be overridden per request with ?progressive=0/1.
+PROGRESSIVE_GROUP_PAGES = False
+
+# How long browsers and shared caches like the edge cache can keep a row from
+# /row, in seconds. Shared caches can keep serving a row for ROW_STALE_TIME
+# more while they fetch a new copy, or for ROW_ERROR_TIME if that fails. Rows
+# that are missing data are only kept for ROW_RETRY_TIME.
+ROW_MAX_AGE = 60
+ROW_SHARED_MAX_AGE = 5 * 60
+ROW_STALE_TIME = 15 * 60
+ROW_ERROR_TIME = 24 * 60 * 60
+ROW_RETRY_TIME = 10
+
+ROLES = ('tank', 'healer', 'dps', 'ranged')
+STATUSES = ('main', 'bench', 'alt')
+
+# The most groups that can be shown on one page.
+MAX_MULTI_GROUPS = 8
+
+# How long, in seconds, a page waits for the Blizzard API before showing the
+# toons that haven't loaded yet from their last good data. Pages rendered in
+# the background wait for everything.
+GROUP_LOAD_DEADLINE = 1.5
 
 CLASS_INDEXES = {
     'Warrior': 1,
@@ -38,60 +70,17 @@ CLASS_INDEXES = {
     'Evoker': 13
 }
 
-TIER_SETS = [1919, 1920, 1921, 1922, 1923, 1924, 1925, 1926, 1927, 1928, 1929, 1930, 1931]
-
-# This is used to color the table cells on the grid display based on the ilvl
-# of the item.  It gets put into the jinja environment as a filter.
-def ilvlcolor(ilvl, quality):
-    retval = ''
-    if quality == 'LEGENDARY':
-        retval = 'background-color:'+COLOR_LEGENDARY
-    elif ilvl > 0 and ilvl < MIN_NORMAL:
-        retval = 'background-color:'+COLOR_LFR
-    elif ilvl >= MIN_NORMAL and ilvl < MIN_HEROIC:
-        retval = 'background-color:'+COLOR_NORMAL
-    elif ilvl >= MIN_HEROIC and ilvl < MIN_MYTHIC:
-        retval = 'background-color:'+COLOR_HEROIC
-    elif ilvl >= MIN_MYTHIC:
-        retval = 'background-color:'+COLOR_MYTHIC
-    return retval
-
 def normalize(groupname):
     return groupname.lower().replace('\'', '').replace(' ', '-')
 
 def build_jqx_widgets(toondata):
-    output = ''
+    output = []
     for toon in toondata:
-        if toon['load_status'] != 'nok':
-            nname = normalize(toon.get('name', ''))
-            guildrealm = toon.get('guild', {}).get('name', '')
-            realm = toon.get('realm', {}).get('name', '')
-            if guildrealm and realm:
-                guildrealm += ' - '
-            guildrealm += realm
-
-            output += '$("#%s-td").jqxTooltip({content: "%s<br/>%s", autoHideDelay: 6000});\n' % (nname, toon['name'], guildrealm)
-    return output
-
-def build_wowhead_rel(item, player_class):
-
-    rel_entries = []
-
-    bonus_lists = item.get('bonusLists', [])
-    if bonus_lists:
-        rel_entries.append('bonus=%s' % ':'.join(map(str, bonus_lists)))
-
-    tooltips = item.get('tooltips', {})
-    if tooltips.get('enchant', ''):
-        rel_entries.append('ench=%s' % tooltips['enchant'])
-
-    if tooltips.get('gems', ''):
-        rel_entries.append('gems=%s' % tooltips['gems'])
-
-    if tooltips.get('set', ''):
-        rel_entries.append('pcs=%s' % tooltips['set'])
-
-    return '&'.join(rel_entries)
+        if toon.load_status != 'nok':
+            nname = normalize(toon.name)
+            guildrealm = ' - '.join(x for x in (toon.guild, toon.realm) if x)
+            output.append('$("#%s-td").jqxTooltip({content: "%s<br/>%s", autoHideDelay: 6000});\n' % (nname, toon.name, guildrealm))
+    return ''.join(output)
 
 class Toonv2(ndb.Model):
     name = ndb.StringProperty(indexed=True)
@@ -107,6 +96,7 @@ class Groupv2(ndb.Model):
     password = ndb.StringProperty()
     toons = ndb.StructuredProperty(Toonv2, repeated=True)
     lastvisited = ndb.DateTimeProperty()
+    visits = ndb.IntegerProperty(default=0)
 
     @staticmethod
     def normalize(realm):
@@ -128,11 +118,16 @@ class Groupv2(ndb.Model):
 
         return results
 
+# Returns the <option> list for the realm selectors. It's only rendered once
+# for each version of the reference data.
+def realm_options(refdata):
+    return pagecache.fragment('realmoptions', refdata.version,
+                              lambda: render_template('realmoptions.html', realms=refdata.realms))
+
 def edit_group(nrealm, ngroup):
 
-    # load the list of realms from the datastore that was loaded by the
-    # /loadrealms service
-    realms = wowapi.Realm.query(namespace='Realms').fetch()
+    # load the list of realms that was loaded by the /initdb service
+    refdata = wowapi.get_reference_data()
 
     # try to load the group info from the database
     results = Groupv2.query_group(nrealm, ngroup)
@@ -146,19 +141,13 @@ def edit_group(nrealm, ngroup):
         for toon in results.toons:
             newtoon = {
                 'name': toon.name,
-                'realm': '',
+                'realm': refdata.realm_names.get(toon.realm, ''),
                 'role': toon.role,
                 'status': toon.status,
             }
 
-            try:
-                realm_lookup = [x.realm for x in realms if x.slug == toon.realm]
-                if not realm_lookup:
-                    logging.error('Failed to lookup realm %s for toon %s' % (toon.realm, toon.name))
-                else:
-                    newtoon['realm'] = str(realm_lookup[0])
-            except IndexError as e:
-                logging.error('failed to lookup realm %s for toon %s: %s' % (toon.realm, toon.name, e))
+            if not newtoon['realm']:
+                logging.error('Failed to lookup realm %s for toon %s' % (toon.realm, toon.name))
 
             toons.append(newtoon)
 
@@ -166,29 +155,24 @@ def edit_group(nrealm, ngroup):
     template_values = {
         'group': ngroup,
         'nrealm': nrealm,
-        'realm': '',
+        'realm': refdata.realm_names.get(nrealm, ''),
         'toons': toons,
-        'realms': realms,
+        'realm_options': realm_options(refdata),
     }
 
-    try:
-        realm_lookup = [x.realm for x in realms if x.slug == nrealm]
-        if not realm_lookup:
-            logging.error('Failed to lookup realm %s for template values' % (nrealm))
-        else:
-            template_values['realm'] = str(realm_lookup[0])
-    except IndexError as e:
-        template_values['realm'] = ''
-        logger.error('failed to lookup realm %s for template values: %s' % (nrealm, e))
+    if not template_values['realm']:
+        logging.error('Failed to lookup realm %s for template values' % (nrealm))
 
     output = render_template('editor.html', **template_values)
     output += render_template('pagefooter.html')
     return output
 
-def get_group(nrealm, ngroup):
+def get_group(nrealm, ngroup, stream=None, progressive=None):
 
     # try to load the group info from the database
-    results = Groupv2.query_group(nrealm, ngroup)
+    timer = metrics.current()
+    with timer.phase('group'):
+        results = Groupv2.query_group(nrealm, ngroup)
 
     # if the group doesn't exist, drop into the interface to make a new
     # group
@@ -196,18 +180,85 @@ def get_group(nrealm, ngroup):
         return redirect('/edit/%s/%s' % (nrealm, ngroup))
 
     # if the group exists, load the group from the blizzard API and display
-    # it.
-    results.lastvisited = datetime.now()
-    results.put()
-    return load_group(results)
+    # it. The visit gets written to the datastore later along with any
+    # others.
+    visits.record_visit(results)
+
+    # Progressive pages don't need anything from Blizzard, so they're built
+    # for every request.
+    if progressive is None:
+        progressive = PROGRESSIVE_GROUP_PAGES
+    if progressive:
+        return render_progressive_group(results), 200
+
+    # Serve the page from the cache if it was rendered for the group's
+    # current roster. Stale pages are still served, but the first request to
+    # see one starts a refresh in the background.
+    roster = pagecache.roster_hash(results)
+    with timer.phase('cache'):
+        entry = pagecache.get(nrealm, ngroup, roster)
+    if entry is not None:
+        if pagecache.is_stale(entry) and pagecache.claim_refresh(nrealm, ngroup):
+            refresh_page(results, roster)
+        return pagecache.respond(entry)
+
+    if stream is None:
+        stream = STREAM_GROUP_PAGES
+    return load_group(results, stream, roster)
+
+# Renders a group page into the page cache on a background thread, so that
+# the request that found the cached copy stale doesn't have to wait for it.
+def refresh_page(results, roster):
+
+    @copy_current_request_context
+    def refresh():
+        try:
+            response, complete = render_group(results)
+            pagecache.store(results.nrealm, results.ngroup, roster, response, fresh=complete)
+        except Exception:
+            logging.exception('failed to refresh page for %s/%s' % (results.nrealm, results.ngroup))
+        finally:
+            pagecache.release_refresh(results.nrealm, results.ngroup)
+
+    threading.Thread(target=refresh).start()
+
+# Returns the json document for a group. Clients that send the ETag of the
+# current document get a 304 without anything being loaded or rendered.
+def get_group_document(nrealm, ngroup):
+
+    timer = metrics.current()
+    with timer.phase('group'):
+        results = Groupv2.query_group(nrealm, ngroup)
+    if results is None:
+        return {'error': 'Group %s/%s does not exist' % (nrealm, ngroup)}, 404
+
+    roster = pagecache.roster_hash(results)
+    with timer.phase('cache'):
+        entry = pagecache.get_document(nrealm, ngroup, roster)
+    if entry is None:
+        refdata = wowapi.get_reference_data()
+        frealm = refdata.realm_names.get(nrealm, '')
+
+        data = []
+        groupstats = new_groupstats()
+        importer = wowapi.Importer()
+        importer.load(nrealm, frealm, results.toons, data, groupstats, refdata,
+                      deadline=GROUP_LOAD_DEADLINE)
+
+        entry = pagecache.store_document(nrealm, ngroup, roster,
+                                         group_document(results, frealm, data, groupstats),
+                                         fresh=loaded_all(importer, data))
+
+    return pagecache.respond_document(entry)
 
 def post_group(request, nrealm, ngroup):
 
     # try to load the group info from the database.  this is only necessary
     # to get the password from the database to verify that it's correct.
     results = Groupv2.query_group(nrealm, ngroup)
+    password = request.form.get('pw', '')
 
-    if results is not None and not sha256_crypt.verify(request.form.get('pw', ''), results.password):
+    if results is not None and not check_password(results, password, request.form.get('session')):
         output = '<html><head><title>Password failure</title></head><body>'
         output += 'Password did not match for this group!<p/>'
         output += '<a href="javascript:history.back()">Go Back</a>\n'
@@ -223,7 +274,12 @@ def post_group(request, nrealm, ngroup):
     group.nrealm = nrealm
     group.ngroup = ngroup
     group.groupname = request.form.get('group', '').strip()
-    group.password = sha256_crypt.encrypt(request.form.get('pw', ''))
+
+    # The password for an existing group was just checked, so it's the one
+    # that's already stored and only needs hashing again if passlib wants to
+    # upgrade the hash.
+    if results is None or sha256_crypt.needs_update(group.password):
+        group.password = sha256_crypt.hash(password)
 
     # load the json data that includes the toon data
     try:
@@ -250,27 +306,19 @@ def post_group(request, nrealm, ngroup):
     # from the memcache after the redirect.
     memcache.set('%s_%s' % (nrealm, ngroup), group)
 
-    # Return a good status so the javascript will redirect to the group page
-    return "", 200
-
-def load_group(results):
-
-    response = ''
+    # The roster changed, so the rendered page is out of date.
+    pagecache.invalidate(nrealm, ngroup)
 
-    # Query ndb for the full realm name based on the results
-    realm_query = wowapi.Realm.query(wowapi.Realm.slug == results.nrealm, namespace='Realms')
-    realm_result = realm_query.fetch()
-    frealm = realm_result[0].realm
+    # Saving the group is also how toons that Blizzard said were missing get
+    # checked again, in case they were fixed or came back.
+    wowapi.CharacterCache.forget_missing([wowapi.character_url(t.realm, t.name) for t in group.toons])
 
-    query = wowapi.ClassEntry.query()
-    res = query.fetch()
-
-    classes = {}
-    for cls in res:
-        classes[cls.classId] = cls.name
+    # Return a good status so the javascript will redirect to the group page
+    return "", 200
 
-    data = []
-    groupstats = {
+# Returns an empty set of stats for a group, to be filled in by the importer.
+def new_groupstats():
+    return {
         'ilvlmains': 0,
         'totalilvl': 0,
         'totalilvleq': 0,
@@ -284,157 +332,390 @@ def load_group(results):
         'healers': 0,
     }
 
-    # Use the API importer to load the data for the group into a list of
-    # entries for each toon.  We'll loop through this data to build up
-    # the page once all of the fetches are finished.
-    importer = wowapi.Importer()
-    importer.load(results.nrealm, frealm, results.toons, data, groupstats)
+# Returns the average ilvl and average equipped ilvl of the mains in a group.
+def group_averages(groupstats):
 
     # Catch the case where no mains were found in the data so we don't
     # divide by zero
     if groupstats['ilvlmains'] == 0:
-        avgilvl = 0
-        avgeqp = 0
-    else:
-        avgilvl = groupstats['totalilvl'] / groupstats['ilvlmains']
-        avgeqp = groupstats['totalilvleq'] / groupstats['ilvlmains']
+        return 0, 0
 
-    # Build the page header with the group name, realm, and ilvl stats
-    template_values = {
+    avgilvl = groupstats['totalilvl'] / groupstats['ilvlmains']
+    avgeqp = groupstats['totalilvleq'] / groupstats['ilvlmains']
+    return round(avgilvl, 2), round(avgeqp, 2)
+
+# Builds the values for the page header with the group name, realm, and ilvl
+# stats.
+def header_values(results, frealm, data, groupstats):
+    avgilvl, avgeqp = group_averages(groupstats)
+    return {
         'group': results.groupname,
         'frealm': frealm,
         'ngroup': results.ngroup,
         'nrealm': results.nrealm,
-        'groupavgilvl': round(avgilvl, 2),
-        'groupavgeqp': round(avgeqp, 2),
+        'groupavgilvl': avgilvl,
+        'groupavgeqp': avgeqp,
         'toondata': data,
         'groupstats': groupstats
     }
 
-    response += render_template('groupinfo-header.html', **template_values)
-    response += '        <hr style="width:90%;clear: both"/><br/>\n'
-    response += render_template('groupinfo-gridheader.html', **template_values)
-    response += '<tbody>\n'
+def legend_values():
+    return {
+        'min_normal': gearrules.MIN_NORMAL,
+        'min_heroic': gearrules.MIN_HEROIC,
+        'min_mythic': gearrules.MIN_MYTHIC,
+        'color_lfr': gearrules.COLOR_LFR,
+        'color_normal': gearrules.COLOR_NORMAL,
+        'color_heroic': gearrules.COLOR_HEROIC,
+        'color_mythic': gearrules.COLOR_MYTHIC,
+    }
 
-    # Loop through the data twice here to display the separate sections,
-    # but don't actually loop through all of the data.  The lambda filters
-    # filter the character data down to just the parts that are needed
-    # for each loop.
-    for idx, char in enumerate(data):
-        response += add_character(char, results, classes)
+# Builds the json document for a group from the data loaded by the importer.
+# It holds the same stats as the page header and a summary of each toon's
+# gear. Nothing in it depends on when it was built, so the ETag for it only
+# changes when the data does.
+def group_document(results, frealm, data, groupstats):
+    avgilvl, avgeqp = group_averages(groupstats)
 
-    response += '</table><p/>\n'
-    template_values = {
-        'min_normal': MIN_NORMAL,
-        'min_heroic': MIN_HEROIC,
-        'min_mythic': MIN_MYTHIC,
-        'color_lfr': COLOR_LFR,
-        'color_normal': COLOR_NORMAL,
-        'color_heroic': COLOR_HEROIC,
-        'color_mythic': COLOR_MYTHIC,
+    toons = []
+    for char in data:
+        toon = {
+            'name': char.name,
+            'realm': char.toonrealm,
+            'status': char.status,
+            'role': char.role,
+            'load_status': char.load_status,
+        }
+
+        if char.load_status == 'nok':
+            toon['reason'] = char.reason
+        else:
+            if char.as_of is not None:
+                toon['as_of'] = int(char.as_of)
+            toon['class'] = char.character_class
+            toon['guild'] = char.guild
+            toon['ilvl'] = char.average_item_level
+            toon['equipped_ilvl'] = char.equipped_item_level
+            toon['avgilvl'] = char.avgilvl
+            toon['tiercount'] = char.tiercount
+
+            if char.items is not None:
+                toon['items'] = dict((slot, {
+                    'id': item.id,
+                    'level': item.level,
+                    'quality': item.quality,
+                    'enchant': item.enchant,
+                    'set': item.set,
+                }) for slot, item in zip(characters.SLOTS, char.items) if item is not None)
+
+        toons.append(toon)
+
+    return {
+        'group': results.groupname,
+        'realm': frealm,
+        'nrealm': results.nrealm,
+        'ngroup': results.ngroup,
+        'stats': groupstats,
+        'avgilvl': avgilvl,
+        'avgeqp': avgeqp,
+        'toons': toons,
     }
-    response += render_template('groupinfo-colorlegend.html', **template_values)
-    response += render_template('pagefooter.html')
+
+# Loads a group from the blizzard API and builds the page for it. If roster is
+# given, the rendered page is also stored in the page cache under it.
+def load_group(results, stream=False, roster=None):
+
+    if stream:
+        status = {}
+        chunks = stream_group(results, status)
+        if roster is not None:
+            chunks = pagecache.tee(results.nrealm, results.ngroup, roster, chunks,
+                                   lambda: status.get('complete', False))
+        return Response(stream_with_context(chunks), mimetype='text/html')
+
+    response, complete = render_group(results, GROUP_LOAD_DEADLINE)
+    if roster is not None:
+        return pagecache.respond(pagecache.store(results.nrealm, results.ngroup, roster, response,
+                                                 fresh=complete))
 
     return response, 200
 
-# Generic method to add a character to the page response
-def add_character(char, results, classes):
+# Returns whether every toon in a load came back with its data within the
+# deadline. Anything built from a load that didn't is cached as stale, so
+# that it gets loaded again instead of keeping an error row until it expires.
+# Toons that Blizzard says don't exist count as loaded, since loading them
+# again won't change anything until the group is edited.
+def loaded_all(importer, data):
+    return importer.late == 0 and all(char.missing or (char.load_status != 'nok' and char.items is not None)
+                                      for char in data)
+
+# Renders a group page. Returns the page, and whether every toon's data was
+# loaded, as worked out by loaded_all.
+def render_group(results, deadline=None):
+
+    # Look up the full realm name from the reference data
+    refdata = wowapi.get_reference_data()
+    frealm = refdata.realm_names.get(results.nrealm, '')
+
+    data = []
+    groupstats = new_groupstats()
+
+    # Use the API importer to load the data for the group into a list of
+    # entries for each toon.  We'll loop through this data to build up
+    # the page once all of the fetches are finished.
+    importer = wowapi.Importer()
+    importer.load(results.nrealm, frealm, results.toons, data, groupstats, refdata, deadline)
+
+    with metrics.current().phase('render'):
+        template_values = header_values(results, frealm, data, groupstats)
+        response = [
+            render_template('groupinfo-header.html', **template_values),
+            '        <hr style="width:90%;clear: both"/><br/>\n',
+            render_template('groupinfo-gridheader.html', **template_values),
+            '<tbody>\n',
+            render_rows(data, results.nrealm),
+            '</table><p/>\n',
+            render_template('groupinfo-colorlegend.html', **legend_values()),
+            render_template('pagefooter.html'),
+        ]
+
+    return ''.join(response), loaded_all(importer, data)
+
+# Shows several groups from the same realm on one page. Groups that don't
+# exist are left out.
+def get_multi_group(nrealm, ngroups):
+
+    groups = []
+    timer = metrics.current()
+    with timer.phase('group'):
+        for ngroup in ngroups[:MAX_MULTI_GROUPS]:
+            results = Groupv2.query_group(nrealm, Groupv2.normalize(ngroup.strip()))
+            if results is not None and results.ngroup not in [g.ngroup for g in groups]:
+                groups.append(results)
+
+    if not groups:
+        return redirect('/')
+
+    for results in groups:
+        visits.record_visit(results)
+
+    return render_multi_group(nrealm, groups), 200
+
+# Renders a section for each of the groups, with its own stats and grid. The
+# rosters are merged first so that a toon in more than one of the groups is
+# only loaded once. Each group's stats are then worked out from the shared
+# results using the group's own status and role for the toon.
+def render_multi_group(nrealm, groups):
+
+    refdata = wowapi.get_reference_data()
+    frealm = refdata.realm_names.get(nrealm, '')
+
+    merged = []
+    seen = set()
+    for results in groups:
+        for toon in results.toons:
+            key = (toon.realm, toon.name.lower())
+            if key not in seen:
+                seen.add(key)
+                merged.append(toon)
+
+    logging.info('loading %d unique toons for %d roster entries' % (
+        len(merged), sum(len(g.toons) for g in groups)))
+
+    data = []
+    importer = wowapi.Importer()
+    importer.load(nrealm, frealm, merged, data, new_groupstats(), refdata, GROUP_LOAD_DEADLINE)
+    loaded = dict(((toon.realm, toon.name.lower()), char) for toon, char in zip(merged, data))
+
+    with metrics.current().phase('render'):
+        response = [render_template('groupinfo-head.html',
+                                    group=', '.join(g.groupname for g in groups), frealm=frealm)]
+
+        for results in groups:
+            groupdata = []
+            groupstats = new_groupstats()
+            for toon in results.toons:
+                char = loaded[(toon.realm, toon.name.lower())].with_roster(toon.status, toon.role)
+                wowapi.Importer.add_stats(char, groupstats)
+                groupdata.append(char)
+
+            template_values = header_values(results, frealm, groupdata, groupstats)
+            template_values['idprefix'] = '%s-' % results.ngroup
+            response += [
+                render_template('groupinfo-stats.html', **template_values),
+                '        <hr style="width:90%;clear: both"/><br/>\n',
+                render_template('groupinfo-gridheader.html', **template_values),
+                '<tbody>\n',
+                render_rows(groupdata, nrealm),
+                '</table><p/>\n',
+            ]
+
+        response.append(render_template('groupinfo-colorlegend.html', **legend_values()))
+        response.append(render_template('pagefooter.html'))
+
+    return ''.join(response)
+
+# Builds a group page with a placeholder row for each toon. The script on the
+# page loads the rows from /row, and then adds up the stats from the data on
+# them.
+def render_progressive_group(results):
+
+    refdata = wowapi.get_reference_data()
+    frealm = refdata.realm_names.get(results.nrealm, '')
+
+    with metrics.current().phase('render'):
+        template_values = header_values(results, frealm, [], new_groupstats())
+        response = [
+            render_template('groupinfo-header.html', **template_values),
+            '        <hr style="width:90%;clear: both"/><br/>\n',
+            render_template('groupinfo-gridheader.html', **template_values),
+            '<tbody>\n',
+            render_template('groupinfo-gridpending.html', toons=results.toons),
+            '</table><p/>\n',
+            render_template('groupinfo-colorlegend.html', **legend_values()),
+            render_template('pagefooter.html'),
+        ]
+
+    return ''.join(response)
+
+# Returns the grid row for one toon, for progressive pages. The row carries
+# the toon's part of the group stats so the page can add them up.
+def get_row(realm, name, role, status):
+
+    if role not in ROLES or status not in STATUSES:
+        return 'Unknown role or status', 400
+
+    refdata = wowapi.get_reference_data()
+    frealm = refdata.realm_names.get(realm)
+    if frealm is None:
+        return 'Unknown realm %s' % realm, 404
+
+    data = []
+    stats = new_groupstats()
+    importer = wowapi.Importer()
+    importer.load(realm, frealm, [Toonv2(name=name, realm=realm, role=role, status=status)],
+                  data, stats, refdata, GROUP_LOAD_DEADLINE)
+    char = data[0]
+
+    with metrics.current().phase('render'):
+        row_values = character_values(char, realm)
+        row_values['stats'] = stats
+        row = render_template('groupinfo-gridrows.html', rows=[row_values])
+
+    if row_values['load_status'] == 'ok' and char.as_of is None:
+        return pagecache.respond_fragment(row, ROW_MAX_AGE, ROW_SHARED_MAX_AGE,
+                                          ROW_STALE_TIME, ROW_ERROR_TIME)
+    return pagecache.respond_fragment(row, 0, ROW_RETRY_TIME)
+
+# Generates the same page as render_group, but sends the header right away
+# and then each character's row as soon as that character has finished
+# loading. The group stats aren't known until the end, so they're sent last
+# as a script that fills them into the header. Since every row is sent as
+# soon as it's ready, streamed pages wait for all of the toons instead of
+# using GROUP_LOAD_DEADLINE. Once the last row is sent, status['complete'] is
+# set to whether every toon loaded, as worked out by loaded_all.
+def stream_group(results, status=None):
+
+    refdata = wowapi.get_reference_data()
+    frealm = refdata.realm_names.get(results.nrealm, '')
+
+    data = []
+    groupstats = new_groupstats()
+
+    template_values = header_values(results, frealm, data, groupstats)
+    yield render_template('groupinfo-header.html', **template_values)
+    yield '        <hr style="width:90%;clear: both"/><br/>\n'
+    yield render_template('groupinfo-gridheader.html', **template_values)
+    yield '<tbody>\n'
 
-    if 'load_status' in char and char['load_status'] == 'nok':
+    # The rows are timed one at a time so the time spent waiting on the
+    # API in between isn't counted as rendering.
+    render_time = 0
+    importer = wowapi.Importer()
+    for char in importer.iter_load(results.nrealm, frealm, results.toons, data, groupstats, refdata):
+        start = time.time()
+        row = render_rows([char], results.nrealm)
+        render_time += time.time() - start
+        yield row
+    metrics.current().add('render', render_time)
+    if status is not None:
+        status['complete'] = loaded_all(importer, data)
+
+    avgilvl, avgeqp = group_averages(groupstats)
+    stats = dict(groupstats, groupavgilvl=avgilvl, groupavgeqp=avgeqp)
+
+    response = '</table><p/>\n'
+    response += '<script>updateGroupStats(%s);</script>\n' % json.dumps(stats)
+    response += render_template('groupinfo-colorlegend.html', **legend_values())
+    response += render_template('pagefooter.html')
+    yield response
+
+# The equipment slots in the order of the grid's columns
+GRID_SLOTS = ('head', 'shoulder', 'chest', 'hands', 'legs', 'neck', 'back',
+              'wrist', 'waist', 'feet', 'finger_1', 'finger_2', 'trinket_1',
+              'trinket_2', 'main_hand', 'off_hand')
+
+# Renders the grid rows for a list of characters with one template call. The
+# styles and wowhead parameters for the item cells were worked out when the
+# equipment was loaded, so the template only has to fill them in.
+def render_rows(chars, nrealm):
+    return render_template('groupinfo-gridrows.html',
+                           rows=[character_values(char, nrealm) for char in chars])
+
+# Returns the values for rendering a character's row in the grid.
+def character_values(char, nrealm):
+
+    if char.load_status == 'nok':
         template_values = {
-            'name': char['name'],
-            'load_status': char['load_status'],
-            'reason': char['reason'],
-            'realm': char['toonrealm'],
-            'frealm': char['toonfrealm'],
+            'name': char.name,
+            'nname': normalize(char.name),
+            'load_status': char.load_status,
+            'reason': char.reason,
+            'realm': char.toonrealm,
+            'frealm': char.toonfrealm,
         }
-    elif 'equipped_items' in char:
-
-        itemslots = ['head', 'shoulder', 'chest', 'hands', 'legs', 'feet', 'neck',
-                     'back', 'wrist', 'waist', 'finger_1', 'finger_2', 'trinket_1',
-                     'trinket_2', 'main_hand', 'off_hand']
-        items = char['equipped_items']
+    elif char.items is not None:
 
         template_values = {
             'load_status': 'ok',
-            'name': char['name'],
-            'frealm': char['toonfrealm'],   # full realm name
-            'nrealm': results.nrealm,  # realm for group
-            'realm': char['toonrealm'],  # realm for toon (might not be == to nrealm)
-            'guild': char.get('guild',{}).get('name', None),
-            'class': char['character_class']['name'],
-            'status': char['status'],
-            'role': char['role'],
-            'tiercount': 0,
+            'name': char.name,
+            'nname': normalize(char.name),
+            'frealm': char.toonfrealm,   # full realm name
+            'nrealm': nrealm,  # realm for group
+            'realm': char.toonrealm,  # realm for toon (might not be == to nrealm)
+            'guild': char.guild,
+            'class': char.character_class,
+            'class_style': char.character_class.replace(' ', '').lower(),
+            'status': char.status,
+            'role': char.role,
+            'tiercount': char.tiercount,
+            'avgilvl': char.avgilvl if char.avgilvl is not None else '',
         }
 
-        avgilvleq = 0
-        numitems = 0
-        for slot in itemslots:
-            template_values[slot] = {
-                'itemLevel': 0,
-                'set': 'no'
-            }
+        if char.as_of is not None:
+            template_values['as_of'] = datetime.utcfromtimestamp(char.as_of).strftime('%b %d %H:%M UTC')
 
-        offhand = False
-        twohander = None
-
-        for item in items:
-            slot = item.get('slot',{}).get('type','').lower()
-
-            # Ignore things like shirts and tabards
-            if slot not in itemslots:
-                continue
-
-            # Count up the item levels and number of items as we go
-            avgilvleq += item['level']['value']
-            numitems += 1
-
-            template_values[slot]['id'] = item['item']['id']
-            template_values[slot]['enchant'] = item['enchant']
-            template_values[slot]['itemLevel'] = item['level']['value']
-            template_values[slot]['bonusLists'] = item.get('bonus_list', [])
-            template_values[slot]['tooltips'] = item['tooltips']
-            template_values[slot]['quality'] = item['quality']['type']
-            template_values[slot]['set'] = 'no'
-
-            # TODO: how do crafted rings/necks show up here? They don't have a profession
-            # requirement to wear them.
-            if 'profession' in item.get('requirements', {}).get('skill', {}):
-                template_values[slot]['set'] = 'crafted'
-            elif item.get('limit_category','') == 'Unique-Equipped: Shadowlands Crafted (1)':
-                template_values[slot]['set'] = 'crafted'
-            elif item.get('set',{}).get('item_set',{}).get('id', 0) in TIER_SETS:
-                template_values[slot]['set'] = 'tier'
-                template_values['tiercount'] += 1
-
-            if slot == 'main_hand' and item.get('inventory_type', {}).get('type') == 'TWOHWEAPON':
-                twohander = item
-            elif slot == 'off_hand':
-                offhand = True
-
-        # if there's no offhand and the main hand is a two-hander, count it double per Blizzard
-        # ilvl formulas. This breaks for classes like Fury that can normally one-hand wield
-        # two-handers, but that's life.
-        if twohander and not offhand:
-            avgilvleq += twohander['level']['value']
-            numitems += 1
-
-        if numitems != 0:
-            template_values['avgilvl'] = round(float(avgilvleq)/float(numitems), 1)
+        template_values['gear'] = [char.item(slot) for slot in GRID_SLOTS]
 
     else:
 
         template_values = {
-            'name': char['name'],
+            'name': char.name,
+            'nname': normalize(char.name),
             'load_status': 'nok',
-            'reason': 'Equipment data was missing for %s.  Refresh to try again' % char['name'],
-            'realm': char['toonrealm'],
-            'frealm': char['toonfrealm'],
+            'reason': 'Equipment data was missing for %s.  Refresh to try again' % char.name,
+            'realm': char.toonrealm,
+            'frealm': char.toonfrealm,
         }
 
-    return render_template('groupinfo-gridtoon.html', **template_values)
+    return template_values
+
+# Checks the password for an existing group. A token from an earlier check in
+# the same editing session saves running the hash again.
+def check_password(group, password, token):
+    if token and editsession.check(token, group, password):
+        return True
+    return sha256_crypt.verify(password, group.password)
 
 def validate_password(request):
     ngroup = request.form['group']
@@ -452,9 +733,15 @@ def validate_password(request):
         results = Groupv2.query_group(nrealm, ngroup)
 
         if results != None:
-            if not sha256_crypt.verify(password, results.password):
+            if not check_password(results, password, request.form.get('session')):
                 return 'Invalid', 401
-            return 'Valid', 200
+
+            # Hand back a token so the save that follows, and any later
+            # checks, can skip the hash.
+            response = Response('Valid')
+            response.headers['X-Edit-Session'] = editsession.issue(results, password)
+            response.cache_control.no_store = True
+            return response
 
         # This covers the case where a group is being added since
         # it won't be in the database yet.
@@ -2,29 +2,39 @@
 #!/usr/bin/env python
 
 from flask import Flask, render_template, request, redirect
-from google.appengine.api import wrap_wsgi_app
+from google.appengine.api import users, wrap_wsgi_app
 
 import grouploader
+import metrics
+import pagecache
+import scheduler
 import wowapi
 
+# How long browsers and caches can keep the front page, in seconds.
+FRONT_PAGE_MAX_AGE = 24 * 60 * 60
+
 app = Flask(__name__)
 app.wsgi_app = wrap_wsgi_app(app.wsgi_app)
 app.debug = True
 
-app.jinja_env.filters['ilvlcolor'] = grouploader.ilvlcolor
 app.jinja_env.filters['normalize'] = grouploader.normalize
-app.jinja_env.filters['build_wowhead_rel'] = grouploader.build_wowhead_rel
 app.jinja_env.filters['build_jqx_widgets'] = grouploader.build_jqx_widgets
 
+# Create the client for the Blizzard API when the instance starts, so the
+# credentials are read before the first request instead of during it.
+wowapi.get_client()
+
 @app.route('/')
 def root():
 
-    # load the list of realms from the datastore that was loaded by the
-    # /loadrealms service
-    query = wowapi.Realm.query(namespace='Realms')
-    realms = query.fetch()
-
-    return render_template('frontpage.html', realms=realms)
+    # The front page only changes when the list of realms loaded by the
+    # /initdb service does, so it's rendered once for each version of the
+    # reference data.
+    refdata = wowapi.get_reference_data()
+    entry = pagecache.static_page('frontpage', refdata.version,
+                                  lambda: render_template('frontpage.html',
+                                                          realm_options=grouploader.realm_options(refdata)))
+    return pagecache.respond_static(entry, FRONT_PAGE_MAX_AGE)
 
 # This class redirects using the input from the form on the main page to the
 # right page for the group.
@@ -48,22 +58,73 @@ def initdb():
     results = setup.initdb(app)
     return 'Loaded %d realms into datastore<br/>\nLoaded %d classes into datastore<br/>' % (results[0], results[1])
 
+# Refreshes the cached pages of the groups that were visited recently. This is
+# run by the cron job in cron.yaml.
+@app.route('/refresh')
+def refresh():
+    if request.headers.get('X-Appengine-Cron') != 'true':
+        return 'Forbidden', 403
+
+    results = scheduler.refresh_recent_groups()
+    return 'Refreshed %d groups using %d API calls<br/>' % (results[0], results[1])
+
+# Reports timing histograms and Blizzard API error rates for this instance.
+# Only admins of the app can see it.
+@app.route('/metrics')
+def metrics_handler():
+    if not users.is_current_user_admin():
+        return 'Forbidden', 403
+
+    return metrics.report()
+
 @app.route('/val', methods=['POST'])
 def validator():
     return grouploader.validate_password(request)
 
+# Shows several groups from the same realm on one page, for example
+# /multi/aerie-peak?groups=main,alts. Each toon is only loaded once, no
+# matter how many of the groups it's in. The path starts with /multi like
+# /api and /edit do, so it can't hide a group that's named multi.
+@app.route('/multi/<nrealm>')
+def multi_handler(nrealm):
+    groups = [g for g in request.args.get('groups', '').split(',') if g.strip()]
+    return grouploader.get_multi_group(nrealm, groups)
+
 @app.route('/<nrealm>/<ngroup>', methods=['GET', 'POST'])
 def group_handler(nrealm, ngroup):
     if request.method == 'GET':
-        return grouploader.get_group(nrealm, ngroup)
+        stream = request.args.get('stream')
+        if stream is not None:
+            stream = stream == '1'
+        progressive = request.args.get('progressive')
+        if progressive is not None:
+            progressive = progressive == '1'
+        return grouploader.get_group(nrealm, ngroup, stream, progressive)
 
     return grouploader.post_group(request, nrealm, ngroup)
 
+# Returns the data for a group as json, for bots and spreadsheets that would
+# otherwise scrape the page.
+@app.route('/api/<nrealm>/<ngroup>')
+def api_handler(nrealm, ngroup):
+    return grouploader.get_group_document(nrealm, ngroup)
+
+# Returns the grid row for one toon, which progressive group pages load
+# separately. Rows are sent with headers that let the edge cache keep them.
+@app.route('/row/<realm>/<name>')
+def row_handler(realm, name):
+    return grouploader.get_row(realm, name, request.args.get('role', 'dps'),
+                               request.args.get('status', 'main'))
+
 @app.route('/edit/<nrealm>/<ngroup>')
 def edit_handler(nrealm, ngroup):
     return grouploader.edit_group(nrealm, ngroup)
 
+@app.before_request
+def start_timer():
+    metrics.start_request()
+
 @app.after_request
 def add_header(response):
     response.headers['Permissions-Policy'] = 'interest-cohort=()'
-    return response
+    return metrics.finish_request(response, request.endpoint)
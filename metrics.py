@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+#!/usr/bin/env python
+
+import time
+import logging
+import threading
+from collections import deque
+from contextlib import contextmanager
+
+from flask import g, has_app_context
+
+# How many of the most recent samples are kept for each histogram.
+SAMPLE_SIZE = 1000
+
+# Timing for the phases of a request. Each request gets a RequestTimer that
+# adds up the time spent in each phase and ends up in the Server-Timing
+# header of the response. Every phase that's timed is also recorded in
+# histograms for the instance, along with the status of every call to the
+# Blizzard API, which the /metrics endpoint reports. The histograms are kept
+# in memory, so each instance reports on the requests it served since it
+# started.
+
+_started = time.time()
+_lock = threading.Lock()
+_histograms = {}
+_statuses = {}
+
+# Keeps the last SAMPLE_SIZE values recorded, and the total count.
+class Histogram(object):
+
+    def __init__(self):
+        self.samples = deque(maxlen=SAMPLE_SIZE)
+        self.count = 0
+
+    def add(self, value):
+        self.samples.append(value)
+        self.count += 1
+
+    def percentile(self, values, pct):
+        idx = min(len(values) - 1, int(round(pct / 100.0 * (len(values) - 1))))
+        return values[idx]
+
+    def summary(self):
+        values = sorted(self.samples)
+        if not values:
+            return {'count': self.count}
+
+        return {
+            'count': self.count,
+            'mean': round(sum(values) / len(values), 2),
+            'p50': round(self.percentile(values, 50), 2),
+            'p95': round(self.percentile(values, 95), 2),
+            'p99': round(self.percentile(values, 99), 2),
+            'max': round(values[-1], 2),
+        }
+
+# Records a value, in milliseconds, in the named histogram.
+def observe(name, ms):
+    with _lock:
+        histogram = _histograms.get(name)
+        if histogram is None:
+            histogram = _histograms[name] = Histogram()
+        histogram.add(ms)
+
+# Counts a response from the Blizzard API for one kind of request.
+def count_status(kind, status):
+    with _lock:
+        statuses = _statuses.setdefault(kind, {})
+        statuses[status] = statuses.get(status, 0) + 1
+
+class RequestTimer(object):
+
+    def __init__(self):
+        self.start = time.time()
+        self.phases = {}
+        self.counts = {}
+        self.lock = threading.Lock()
+
+    # Adds time to a phase. This is safe to call from the worker threads.
+    def add(self, phase, seconds, count=1):
+        ms = seconds * 1000.0
+        with self.lock:
+            self.phases[phase] = self.phases.get(phase, 0.0) + ms
+            self.counts[phase] = self.counts.get(phase, 0) + count
+        observe(phase, ms)
+
+    @contextmanager
+    def phase(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add(name, time.time() - start)
+
+    # Records a request to the Blizzard API for a toon. The latency goes in
+    # a phase for the kind of request, and the toon's own latency and status
+    # are logged.
+    def fetch(self, kind, name, response):
+        if isinstance(response, Exception):
+            status = type(response).__name__
+            seconds = 0
+        else:
+            status = response.status_code
+            seconds = response.elapsed.total_seconds()
+
+        self.add(kind, seconds)
+        count_status(kind, status)
+        logging.info('%s request for %s took %.1f ms (%s)' % (kind, name, seconds * 1000.0, status))
+
+    def header(self):
+        entries = []
+        with self.lock:
+            for phase, ms in self.phases.items():
+                if self.counts[phase] > 1:
+                    entries.append('%s;desc="%d calls";dur=%.1f' % (phase, self.counts[phase], ms))
+                else:
+                    entries.append('%s;dur=%.1f' % (phase, ms))
+        entries.append('total;dur=%.1f' % ((time.time() - self.start) * 1000.0))
+        return ', '.join(entries)
+
+# Returns the timer for the current request. Outside of a request, like on
+# the threads that refresh cached pages, the phases still go in the
+# histograms but aren't reported anywhere else.
+def current():
+    if has_app_context():
+        timer = g.get('timer')
+        if timer is None:
+            timer = g.timer = RequestTimer()
+        return timer
+    return RequestTimer()
+
+def start_request():
+    g.timer = RequestTimer()
+
+# Adds the Server-Timing header to a response and records the time for the
+# whole request. For streamed responses this only covers the time until the
+# response started.
+def finish_request(response, endpoint):
+    timer = current()
+    response.headers['Server-Timing'] = timer.header()
+    observe('request.%s' % endpoint, (time.time() - timer.start) * 1000.0)
+    return response
+
+# Returns the histograms and Blizzard API status counts for the instance.
+def report():
+    with _lock:
+        histograms = dict((name, h.summary()) for name, h in _histograms.items())
+        statuses = dict((kind, dict(s)) for kind, s in _statuses.items())
+
+    blizzard = {}
+    for kind, counts in statuses.items():
+        total = sum(counts.values())
+        errors = sum(v for k, v in counts.items() if k not in (200, 304))
+        blizzard[kind] = {
+            'requests': total,
+            'errors': errors,
+            'error_rate': round(float(errors) / total, 4) if total else 0.0,
+            'statuses': dict((str(k), v) for k, v in counts.items()),
+        }
+
+    return {
+        'uptime': int(time.time() - _started),
+        'sample_size': SAMPLE_SIZE,
+        'timings_ms': histograms,
+        'blizzard': blizzard,
+    }
@@ -0,0 +1,229 @@
+# -*- coding: utf-8 -*-
+#!/usr/bin/env python
+
+import gzip
+import json
+import time
+import hashlib
+import logging
+import threading
+
+from flask import request, Response
+from markupsafe import Markup
+from google.appengine.api import memcache
+
+# Brotli is in requirements.txt, so deployed instances keep a brotli copy of
+# every page. Without it, as when running the benchmarks or tests locally,
+# pages are only compressed with gzip.
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# How long a rendered group page is served as-is, in seconds. After that it's
+# stale: it can still be served for up to STALE_TIME more seconds, but the
+# first request to see it stale also starts a refresh in the background.
+FRESH_TIME = 60
+STALE_TIME = 15 * 60
+
+# How long a refresh is allowed to hold the lock that keeps other requests
+# from starting a refresh of the same page.
+REFRESH_LOCK_TIME = 60
+
+# Cache of fully rendered group pages. Each entry is stored in memcache along
+# with compressed copies of the page, so a hit is a memcache read and sending
+# the bytes. Entries are tied to a hash of the group's roster, so a page
+# rendered for an older roster is never served. The json documents served by
+# the api are cached the same way, next to the pages.
+
+def page_key(nrealm, ngroup):
+    return 'page_%s_%s' % (nrealm, ngroup)
+
+def document_key(nrealm, ngroup):
+    return 'api_%s_%s' % (nrealm, ngroup)
+
+def lock_key(nrealm, ngroup):
+    return 'pagelock_%s_%s' % (nrealm, ngroup)
+
+# Returns a hash of everything in a group that shows up on its page other
+# than the data from Blizzard.
+def roster_hash(group):
+    roster = hashlib.sha1()
+    roster.update((group.groupname or '').encode('utf-8'))
+    for toon in group.toons:
+        roster.update(('|%s/%s/%s/%s' % (toon.name, toon.realm, toon.role, toon.status)).encode('utf-8'))
+    return roster.hexdigest()
+
+# Returns the cached entry for a group page, or None if there isn't one for
+# the group's current roster.
+def get(nrealm, ngroup, roster):
+    entry = memcache.get(page_key(nrealm, ngroup))
+    if entry is None or entry['roster'] != roster:
+        return None
+    return entry
+
+def is_stale(entry):
+    return time.time() - entry['created'] > FRESH_TIME
+
+# Returns a page along with compressed copies of it.
+def compress(html):
+    body = html.encode('utf-8')
+    return {
+        'body': body,
+        'gzip': gzip.compress(body),
+        'br': brotli.compress(body) if brotli is not None else None,
+    }
+
+# Compresses and stores a rendered page, and returns the new cache entry. A
+# page that's missing data is stored as already stale, so the next request
+# for it starts a refresh.
+def store(nrealm, ngroup, roster, html, fresh=True):
+    entry = compress(html)
+    entry['roster'] = roster
+    entry['created'] = time.time() if fresh else time.time() - FRESH_TIME - 1
+
+    if not memcache.set(page_key(nrealm, ngroup), entry, time=FRESH_TIME + STALE_TIME):
+        logging.warning('failed to store rendered page for %s/%s' % (nrealm, ngroup))
+    return entry
+
+def invalidate(nrealm, ngroup):
+    memcache.delete_multi([page_key(nrealm, ngroup), document_key(nrealm, ngroup)])
+
+# Returns the cached json document for a group, or None if there isn't a
+# fresh one for the group's current roster. Documents aren't served stale,
+# since the clients polling them are looking for changes.
+def get_document(nrealm, ngroup, roster):
+    entry = memcache.get(document_key(nrealm, ngroup))
+    if entry is None or entry['roster'] != roster or is_stale(entry):
+        return None
+    return entry
+
+# Serializes and stores the json document for a group, and returns the new
+# cache entry. The ETag is a hash of the serialized document, so it only
+# changes when the content does. A document from a load that didn't finish
+# is stored as already stale, so the next request loads it again. Toons that
+# don't exist don't count as unfinished, or every poll of a group with one
+# would load the whole group from Blizzard.
+def store_document(nrealm, ngroup, roster, document, fresh=True):
+    body = json.dumps(document, sort_keys=True, separators=(',', ':')).encode('utf-8')
+    entry = {
+        'roster': roster,
+        'created': time.time() if fresh else time.time() - FRESH_TIME - 1,
+        'body': body,
+        'etag': hashlib.sha1(body).hexdigest(),
+    }
+
+    if not memcache.set(document_key(nrealm, ngroup), entry, time=FRESH_TIME):
+        logging.warning('failed to store json document for %s/%s' % (nrealm, ngroup))
+    return entry
+
+# Claims the right to refresh a page. Only one request gets it until the
+# refresh finishes or the lock expires.
+def claim_refresh(nrealm, ngroup):
+    return memcache.add(lock_key(nrealm, ngroup), 1, time=REFRESH_LOCK_TIME)
+
+def release_refresh(nrealm, ngroup):
+    memcache.delete(lock_key(nrealm, ngroup))
+
+# Passes through the chunks of a streamed page, and stores the whole page
+# once the last chunk has been sent. complete is called then to find out
+# whether the page has all of its data, the same as fresh for store.
+def tee(nrealm, ngroup, roster, chunks, complete):
+    parts = []
+    for chunk in chunks:
+        parts.append(chunk)
+        yield chunk
+    store(nrealm, ngroup, roster, ''.join(parts), fresh=complete())
+
+# Builds a response for a json document entry, or a 304 if the client already
+# has the current version.
+def respond_document(entry):
+    response = Response(mimetype='application/json')
+    response.set_etag(entry['etag'])
+    response.cache_control.no_cache = True
+
+    if request.if_none_match.contains(entry['etag']):
+        response.status_code = 304
+    else:
+        response.data = entry['body']
+
+    return response
+
+# Builds a response for a cache entry in the best encoding the browser
+# accepts.
+def respond(entry):
+    response = Response(mimetype='text/html')
+    response.vary.add('Accept-Encoding')
+
+    encodings = request.accept_encodings
+    if entry['br'] is not None and encodings['br']:
+        response.data = entry['br']
+        response.content_encoding = 'br'
+    elif encodings['gzip']:
+        response.data = entry['gzip']
+        response.content_encoding = 'gzip'
+    else:
+        response.data = entry['body']
+
+    return response
+
+# Pages and fragments that only depend on the reference data are rendered
+# once per version of it and kept in memory. Entries for older versions are
+# dropped as soon as a newer one is rendered.
+_static = {}
+_static_lock = threading.Lock()
+
+def _static_entry(name, version, build):
+    entry = _static.get((name, version))
+    if entry is None:
+        entry = build()
+        with _static_lock:
+            for key in [k for k in _static if k[0] == name and k[1] != version]:
+                del _static[key]
+            _static[(name, version)] = entry
+    return entry
+
+# Returns an html fragment, calling render to build it the first time it's
+# needed for a version.
+def fragment(name, version, render):
+    return _static_entry(name, version, lambda: Markup(render()))
+
+# Returns a compressed page entry, calling render to build it the first time
+# it's needed for a version. The entry's ETag is a hash of the page.
+def static_page(name, version, render):
+    def build():
+        entry = compress(render())
+        entry['etag'] = hashlib.sha1(entry['body']).hexdigest()
+        return entry
+    return _static_entry(name, version, build)
+
+# Builds a response for an html fragment that browsers can keep for max_age
+# seconds and shared caches like the edge cache for shared_max_age. Shared
+# caches can also keep serving it for stale_time more while they fetch a new
+# copy, and for error_time if fetching one fails. The ETag is a hash of the
+# fragment, so revalidating only sends it again if it changed.
+def respond_fragment(html, max_age, shared_max_age, stale_time=0, error_time=0):
+    entry = compress(html)
+    entry['etag'] = hashlib.sha1(entry['body']).hexdigest()
+
+    response = respond_static(entry, max_age)
+    response.cache_control.s_maxage = shared_max_age
+    if stale_time:
+        response.cache_control.stale_while_revalidate = stale_time
+    if error_time:
+        response.cache_control.stale_if_error = error_time
+    return response
+
+# Builds a response for a static page entry that browsers and caches can keep
+# for max_age seconds, or a 304 if the client already has it.
+def respond_static(entry, max_age):
+    if request.if_none_match.contains(entry['etag']):
+        response = Response(status=304)
+        response.vary.add('Accept-Encoding')
+    else:
+        response = respond(entry)
+
+    response.set_etag(entry['etag'])
+    response.cache_control.public = True
+    response.cache_control.max_age = max_age
+    return response
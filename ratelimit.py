@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+#!/usr/bin/env python
+
+import time
+import logging
+import threading
+
+from google.appengine.api import memcache
+
+# Blizzard's published limits for API clients are 100 requests per second and
+# 36,000 requests per hour, shared by everything using the same client id.
+BLIZZARD_PER_SECOND = 100
+BLIZZARD_PER_HOUR = 36000
+
+# A token bucket that hands out reservations instead of blocking. Each call to
+# take() removes tokens immediately, letting the bucket go negative, and
+# returns how long the caller has to wait before its tokens would have been
+# available. Concurrent callers end up spaced out at the bucket's rate rather
+# than all waking up at the same moment.
+class TokenBucket(object):
+
+    def __init__(self, rate, capacity):
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    # Reserves count tokens and returns the number of seconds until they
+    # can be used.
+    def take(self, count=1):
+        with self.lock:
+            self._refill(time.monotonic())
+            self.tokens -= count
+            if self.tokens >= 0:
+                return 0.0
+            return -self.tokens / self.rate
+
+    # Returns how long a reservation of count tokens would wait right now,
+    # without making one.
+    def wait_time(self, count=1):
+        with self.lock:
+            self._refill(time.monotonic())
+            missing = count - self.tokens
+            if missing <= 0:
+                return 0.0
+            return missing / self.rate
+
+# Limits the outbound calls to the Blizzard API with a per-second and a
+# per-hour bucket. The buckets are local to the instance, but when shared is
+# set, claim_shared() also counts calls in memcache windows that every
+# instance increments, and the calls the other instances made are charged to
+# the local buckets. That way the waits stay in the worker threads making the
+# requests while still accounting for the other instances.
+class RateLimiter(object):
+
+    def __init__(self, per_second=BLIZZARD_PER_SECOND, per_hour=BLIZZARD_PER_HOUR, shared=False):
+        self.shared = shared
+        self.second_bucket = TokenBucket(per_second, per_second)
+        self.hour_bucket = TokenBucket(per_hour / 3600.0, per_hour)
+
+        # For each of the current shared windows, the number of calls this
+        # instance claimed and the number of calls by other instances that
+        # were already charged locally.
+        self.windows = {}
+        self.lock = threading.Lock()
+
+    # Reserves count calls and returns the number of seconds the caller has
+    # to wait before making them.
+    def reserve(self, count=1):
+        return max(self.second_bucket.take(count), self.hour_bucket.take(count))
+
+    # Reserves count calls and sleeps until they can be made. This should only
+    # be called from the threads actually making the requests. Returns the
+    # number of seconds that were spent waiting.
+    def acquire(self, count=1):
+        delay = self.reserve(count)
+        if delay > 0:
+            time.sleep(delay)
+        return delay
+
+    # Returns how long a call made right now would have to wait.
+    def wait_time(self, count=1):
+        return max(self.second_bucket.wait_time(count), self.hour_bucket.wait_time(count))
+
+    # Records count upcoming calls in the memcache windows shared by all of
+    # the instances. This makes memcache calls, so it needs to be called from
+    # the request thread before the calls are handed off to the workers.
+    # Returns the estimated wait for the calls once the other instances' calls
+    # were charged to the local buckets.
+    def claim_shared(self, count):
+        if not self.shared or count <= 0:
+            return self.wait_time(count)
+
+        # The counters for old windows are never read again and are left for
+        # memcache to evict.
+        now = time.time()
+        second_key = 'ratelimit_s_%d' % int(now)
+        hour_key = 'ratelimit_h_%d' % int(now / 3600)
+
+        try:
+            counts = memcache.offset_multi({second_key: count, hour_key: count},
+                                           initial_value=0)
+        except Exception as e:
+            logging.error('failed to update shared rate limit counters: %s' % e)
+            counts = {}
+
+        with self.lock:
+            windows = {}
+            for key, bucket in ((second_key, self.second_bucket),
+                                (hour_key, self.hour_bucket)):
+                own, charged = self.windows.get(key, (0, 0))
+                own += count
+                windows[key] = (own, charged)
+
+                total = counts.get(key)
+                if total is None:
+                    continue
+
+                # This instance's own calls are charged when the workers
+                # reserve them, so only charge for the calls the other
+                # instances made since the last claim in this window.
+                others = total - own
+                if others > charged:
+                    bucket.take(others - charged)
+                    windows[key] = (own, others)
+
+            self.windows = windows
+
+        return self.wait_time(count)
+
+# The limiter shared by every call to the Blizzard API from this instance.
+limiter = RateLimiter(shared=True)
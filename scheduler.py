@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+#!/usr/bin/env python
+
+import logging
+from datetime import datetime, timedelta
+
+import grouploader
+import pagecache
+import visits
+
+# Groups visited within this many hours get their pages refreshed by the
+# cron job.
+REFRESH_WINDOW_HOURS = 6
+
+# The maximum number of Blizzard API calls one run of the cron job can make.
+# Each toon costs two calls, one for the profile and one for the equipment.
+REFRESH_API_BUDGET = 3000
+
+# Refreshes the cached pages for the groups that were visited recently, the
+# busiest and then most recently visited first, so that the people opening
+# them during raid hours get a page that was already rendered instead of
+# waiting on the Blizzard API. Pages that are still fresh are left alone, and
+# groups that don't fit in what's left of the budget are skipped. Returns the
+# number of groups that were refreshed and the number of API calls that were
+# used.
+def refresh_recent_groups(hours=REFRESH_WINDOW_HOURS, budget=REFRESH_API_BUDGET):
+
+    # Write out the visits every instance has seen so they're included.
+    flushed = visits.flush()
+
+    cutoff = datetime.now() - timedelta(hours=hours)
+    query = grouploader.Groupv2.query(grouploader.Groupv2.lastvisited >= cutoff)
+    groups = query.order(-grouploader.Groupv2.lastvisited).fetch()
+
+    # Groups that are getting visited right now go first. The sort is stable,
+    # so the rest stay in order of their last visit.
+    # The flush reset the counters for the groups it wrote, so the visits it
+    # took are added back in.
+    counts = visits.recent_counts(groups)
+    for group, count in flushed.items():
+        counts[group] = counts.get(group, 0) + count
+    groups.sort(key=lambda g: counts.get((g.nrealm, g.ngroup), 0), reverse=True)
+
+    refreshed = 0
+    spent = 0
+    for group in groups:
+        roster = pagecache.roster_hash(group)
+        entry = pagecache.get(group.nrealm, group.ngroup, roster)
+        if entry is not None and not pagecache.is_stale(entry):
+            continue
+
+        cost = 2 * len(group.toons)
+        if spent + cost > budget:
+            logging.info('skipping refresh of %s/%s, only %d of the API budget left' % (group.nrealm, group.ngroup, budget - spent))
+            continue
+
+        if not pagecache.claim_refresh(group.nrealm, group.ngroup):
+            continue
+
+        try:
+            html, complete = grouploader.render_group(group)
+            pagecache.store(group.nrealm, group.ngroup, roster, html, fresh=complete)
+            refreshed += 1
+            spent += cost
+        except Exception:
+            logging.exception('failed to refresh page for %s/%s' % (group.nrealm, group.ngroup))
+        finally:
+            pagecache.release_refresh(group.nrealm, group.ngroup)
+
+    logging.info('refreshed %d of %d recently visited groups using %d API calls' % (refreshed, len(groups), spent))
+    return refreshed, spent
@@ -52,14 +52,19 @@ function changeRealm(e) {
   lastClicked = e.currentTarget;
 };
 
+// Token from /val that lets later password checks while editing skip hashing
+// the password again on the server.
+var editSession = '';
+
 function authPw() {
   // validate the password before doing anything else
   let pw=$("#pw").val();
-  let data='group='+ngroup+'&realm='+nrealm+'&pw='+pw;
+  let data='group='+ngroup+'&realm='+nrealm+'&pw='+pw+'&session='+editSession;
 
   $.post('/val', data)
-    .done(function() {
+    .done(function(result, status, xhr) {
       console.log('password authentication success');
+      editSession = xhr.getResponseHeader('X-Edit-Session') || editSession;
       postdata();
     })
     .fail(function() {
@@ -76,7 +81,7 @@ function postdata() {
   let pw = $('#pw').val();
   let json = buildjson();
 
-  let data = 'group='+groupname+'&json='+json+'&pw='+pw;
+  let data = 'group='+groupname+'&json='+json+'&pw='+pw+'&session='+editSession;
 
   $.post(url, data)
     .done(function() {
@@ -1,15 +1,69 @@
 var nrealm = null;
 var ngroup = null;
 
+// Fills in the group stats in the page header. Streamed pages send the header
+// before any of the characters have loaded, so the stats arrive at the end.
+function updateGroupStats(stats) {
+  $.each(stats, function(key, value) {
+    $("#stat-" + key).text(value);
+  });
+}
+
+// Loads the rows of a progressive page. Each placeholder row has the URL of
+// the toon's row, which replaces it once it arrives. When all of them are in,
+// the group stats are added up from the rows and the table is sorted again.
+function loadRows() {
+  var rows = $("tr[data-row]");
+  var remaining = rows.length;
+
+  rows.each(function() {
+    var placeholder = $(this);
+    $.get(placeholder.data("row")).done(function(html) {
+      placeholder.replaceWith(html);
+    }).fail(function() {
+      placeholder.find("td.pending").text("Failed to load this toon. Refresh page to try again.");
+    }).always(function() {
+      remaining -= 1;
+      if (remaining == 0) {
+        updateGroupStats(addRowStats());
+        $("table.tablesorter").trigger("update");
+      }
+    });
+  });
+}
+
+// Adds up each row's part of the group stats, and works out the average ilvls
+// of the mains the same way the server does.
+function addRowStats() {
+  var stats = {};
+  $("tr[data-stats]").each(function() {
+    $.each($(this).data("stats"), function(key, value) {
+      stats[key] = (stats[key] || 0) + value;
+    });
+  });
+
+  stats.groupavgilvl = 0;
+  stats.groupavgeqp = 0;
+  if (stats.ilvlmains) {
+    stats.groupavgilvl = Math.round(stats.totalilvl / stats.ilvlmains * 100) / 100;
+    stats.groupavgeqp = Math.round(stats.totalilvleq / stats.ilvlmains * 100) / 100;
+  }
+  return stats;
+}
+
 $(document).ready(function() {
   nrealm = $("#nrealm").val();
   ngroup = $("#ngroup").val();
 
-  $("#roster").tablesorter({
+  $("table.tablesorter").tablesorter({
     // set forced sort on the third column to ensure that subs are always at the bottom
     sortForce: [[2,1]],
     // default sort order is by group (to fix the above force sorting), then avg equipped
     // (descending) and finally name (ascending)
     sortList: [[2,1],[3,1],[0,0]],
   });
+
+  if ($("tr[data-row]").length) {
+    loadRows();
+  }
 });
@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+#!/usr/bin/env python
+
+# Checks that clients polling a group's json document are answered from the
+# cache, using the stand-ins from the benchmarks.
+#
+# python3 -m unittest discover tests
+
+import os
+import sys
+import logging
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.split(__file__)[0], '..', 'benchmarks'))
+import standins
+
+class DocumentTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        logging.disable(logging.ERROR)
+        cls.api, cls.mc, cls.groups = standins.install()
+
+        from main import app
+        import grouploader
+        cls.app = app
+        cls.grouploader = grouploader
+
+    @classmethod
+    def tearDownClass(cls):
+        logging.disable(logging.NOTSET)
+
+    def setUp(self):
+        self.groups.groups.clear()
+        self.mc.data.clear()
+        self.api.errors.clear()
+
+    def make_group(self, ngroup, size):
+        group = self.grouploader.Groupv2(nrealm=self.api.roster['realm'], ngroup=ngroup,
+                                         groupname=ngroup.title(), password='')
+        group.toons = [self.grouploader.Toonv2(**t) for t in self.api.make_roster(size)]
+        group.toons.append(self.grouploader.Toonv2(name='Nobody', realm=group.nrealm,
+                                                    role='dps', status='main'))
+        self.groups.put(group)
+        return group
+
+    def poll(self, group):
+        before = self.api.calls
+        response = self.app.test_client().get('/api/%s/%s' % (group.nrealm, group.ngroup))
+        self.assertEqual(response.status_code, 200)
+        return self.api.calls - before
+
+    def test_polls_use_cache_with_missing_toon(self):
+        group = self.make_group('polled', 10)
+
+        self.assertEqual(self.poll(group), 21)
+        for i in range(3):
+            self.assertEqual(self.poll(group), 0)
+
+    def test_polls_reload_failed_toons(self):
+        group = self.make_group('flaky', 3)
+        self.api.errors[group.toons[0].name.lower()] = 503
+
+        self.assertGreater(self.poll(group), 0)
+        self.assertGreater(self.poll(group), 0)
+
+if __name__ == '__main__':
+    unittest.main()
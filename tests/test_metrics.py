@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+#!/usr/bin/env python
+
+# Checks that the metrics page is only shown to admins of the app.
+#
+# python3 -m unittest discover tests
+
+import os
+import sys
+import logging
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.split(__file__)[0], '..', 'benchmarks'))
+import standins
+
+class MetricsTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        logging.disable(logging.WARNING)
+        standins.install()
+
+        from main import app
+        cls.app = app
+
+    @classmethod
+    def tearDownClass(cls):
+        logging.disable(logging.NOTSET)
+
+    def test_metrics_requires_admin(self):
+        response = self.app.test_client().get('/metrics')
+        self.assertEqual(response.status_code, 403)
+
+    def test_metrics_for_admin(self):
+        response = self.app.test_client().get('/metrics', headers={'X-Appengine-User-Is-Admin': '1'})
+        self.assertEqual(response.status_code, 200)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+#!/usr/bin/env python
+
+# Checks that the page showing several groups at once doesn't get in the way
+# of a group's own page, using the stand-ins from the benchmarks.
+#
+# python3 -m unittest discover tests
+
+import os
+import sys
+import logging
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.split(__file__)[0], '..', 'benchmarks'))
+import standins
+
+class MultiTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        logging.disable(logging.ERROR)
+        cls.api, cls.mc, cls.groups = standins.install()
+
+        from main import app
+        import grouploader
+        cls.app = app
+        cls.grouploader = grouploader
+
+    @classmethod
+    def tearDownClass(cls):
+        logging.disable(logging.NOTSET)
+
+    def setUp(self):
+        self.groups.groups.clear()
+        self.mc.data.clear()
+
+    def make_group(self, ngroup, size):
+        group = self.grouploader.Groupv2(nrealm=self.api.roster['realm'], ngroup=ngroup,
+                                         groupname=ngroup.title(), password='')
+        group.toons = [self.grouploader.Toonv2(**t) for t in self.api.make_roster(size)]
+        self.groups.put(group)
+        return group
+
+    def test_group_named_multi(self):
+        group = self.make_group('multi', 2)
+        response = self.app.test_client().get('/%s/multi' % group.nrealm)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'<title>Multi - ', response.data)
+
+    def test_multi_page(self):
+        one = self.make_group('one', 2)
+        self.make_group('two', 2)
+        response = self.app.test_client().get('/multi/%s?groups=one,two' % one.nrealm)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'One', response.data)
+        self.assertIn(b'Two', response.data)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+#!/usr/bin/env python
+
+# Runs the cron job that refreshes cached group pages against the stand-ins
+# from the benchmarks, so a change that breaks it can't go unnoticed behind
+# the job's exception handling.
+#
+# python3 -m unittest discover tests
+
+import os
+import sys
+import logging
+import unittest
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.split(__file__)[0], '..', 'benchmarks'))
+import standins
+
+class RefreshTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        logging.disable(logging.ERROR)
+        cls.api, cls.mc, cls.groups = standins.install()
+
+        from main import app
+        import grouploader
+        cls.app = app
+        cls.grouploader = grouploader
+
+    @classmethod
+    def tearDownClass(cls):
+        logging.disable(logging.NOTSET)
+
+    def setUp(self):
+        self.groups.groups.clear()
+        self.mc.data.clear()
+        self.api.errors.clear()
+
+    def make_group(self, ngroup, size):
+        group = self.grouploader.Groupv2(nrealm=self.api.roster['realm'], ngroup=ngroup,
+                                         groupname=ngroup.title(), password='',
+                                         lastvisited=datetime.now())
+        group.toons = [self.grouploader.Toonv2(**t) for t in self.api.make_roster(size)]
+        self.groups.put(group)
+        return group
+
+    def test_refresh_stores_fresh_pages(self):
+        import pagecache
+
+        group = self.make_group('cron', 10)
+        client = self.app.test_client()
+        response = client.get('/refresh', headers={'X-Appengine-Cron': 'true'})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'Refreshed 1 groups using 20 API calls', response.data)
+
+        entry = pagecache.get(group.nrealm, group.ngroup, pagecache.roster_hash(group))
+        self.assertIsNotNone(entry)
+        self.assertFalse(pagecache.is_stale(entry))
+        self.assertIn(b'<title>Cron - ', entry['body'])
+
+        # The page is fresh now, so the next run leaves it alone.
+        response = client.get('/refresh', headers={'X-Appengine-Cron': 'true'})
+        self.assertIn(b'Refreshed 0 groups using 0 API calls', response.data)
+
+    def test_refresh_keeps_failed_pages_stale(self):
+        import pagecache
+
+        group = self.make_group('broken', 3)
+        self.api.errors[group.toons[0].name.lower()] = 503
+        client = self.app.test_client()
+        client.get('/refresh', headers={'X-Appengine-Cron': 'true'})
+
+        # A toon that failed to load means the page is tried again next time.
+        entry = pagecache.get(group.nrealm, group.ngroup, pagecache.roster_hash(group))
+        self.assertIsNotNone(entry)
+        self.assertTrue(pagecache.is_stale(entry))
+
+    def test_refresh_keeps_missing_toons_fresh(self):
+        import pagecache
+
+        group = self.make_group('renamed', 3)
+        group.toons.append(self.grouploader.Toonv2(name='Nobody', realm=group.nrealm,
+                                                    role='dps', status='main'))
+        client = self.app.test_client()
+        client.get('/refresh', headers={'X-Appengine-Cron': 'true'})
+
+        # Loading a toon that doesn't exist again won't change the page.
+        entry = pagecache.get(group.nrealm, group.ngroup, pagecache.roster_hash(group))
+        self.assertIsNotNone(entry)
+        self.assertFalse(pagecache.is_stale(entry))
+
+        response = client.get('/refresh', headers={'X-Appengine-Cron': 'true'})
+        self.assertIn(b'Refreshed 0 groups using 0 API calls', response.data)
+
+    def test_refresh_requires_cron(self):
+        response = self.app.test_client().get('/refresh')
+        self.assertEqual(response.status_code, 403)
+
+if __name__ == '__main__':
+    unittest.main()
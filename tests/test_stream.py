@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+#!/usr/bin/env python
+
+# Checks that streamed group pages are cached the same way as pages rendered
+# in one go, using the stand-ins from the benchmarks.
+#
+# python3 -m unittest discover tests
+
+import os
+import sys
+import logging
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.split(__file__)[0], '..', 'benchmarks'))
+import standins
+
+class StreamTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        logging.disable(logging.ERROR)
+        cls.api, cls.mc, cls.groups = standins.install()
+
+        from main import app
+        import grouploader
+        cls.app = app
+        cls.grouploader = grouploader
+
+    @classmethod
+    def tearDownClass(cls):
+        logging.disable(logging.NOTSET)
+
+    def setUp(self):
+        self.groups.groups.clear()
+        self.mc.data.clear()
+        self.api.errors.clear()
+
+    def stream(self, ngroup, size, extra=()):
+        import pagecache
+
+        group = self.grouploader.Groupv2(nrealm=self.api.roster['realm'], ngroup=ngroup,
+                                         groupname=ngroup.title(), password='')
+        group.toons = [self.grouploader.Toonv2(**t) for t in self.api.make_roster(size)]
+        group.toons += [self.grouploader.Toonv2(name=name, realm=group.nrealm, role='dps', status='main')
+                        for name in extra]
+        self.groups.put(group)
+
+        response = self.app.test_client().get('/%s/%s?stream=1' % (group.nrealm, ngroup))
+        self.assertEqual(response.status_code, 200)
+        response.get_data()
+        return group, pagecache.get(group.nrealm, ngroup, pagecache.roster_hash(group))
+
+    def test_stream_stores_fresh_page(self):
+        import pagecache
+        group, entry = self.stream('streamed', 3, ['Nobody'])
+        self.assertIsNotNone(entry)
+        self.assertFalse(pagecache.is_stale(entry))
+
+    def test_stream_keeps_failed_page_stale(self):
+        import pagecache
+        self.api.errors[self.api.make_roster(1)[0]['name'].lower()] = 503
+        group, entry = self.stream('streamfail', 3)
+        self.assertIsNotNone(entry)
+        self.assertTrue(pagecache.is_stale(entry))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+#!/usr/bin/env python
+
+# Checks that visits counted in memcache end up on the groups when they're
+# flushed, using the stand-ins from the benchmarks. There's no datastore
+# here, so the stand-ins replace visits.write_visits with a copy that works
+# on the in-memory groups. These tests cover the counting, the pending set
+# and the batching, but not the ndb transaction itself.
+#
+# python3 -m unittest discover tests
+
+import os
+import sys
+import logging
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.split(__file__)[0], '..', 'benchmarks'))
+import standins
+
+class VisitsTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        logging.disable(logging.WARNING)
+        cls.api, cls.mc, cls.groups = standins.install()
+
+        import grouploader
+        import visits
+        cls.grouploader = grouploader
+        cls.visits = visits
+
+    @classmethod
+    def tearDownClass(cls):
+        logging.disable(logging.NOTSET)
+
+    def setUp(self):
+        self.groups.groups.clear()
+        self.mc.data.clear()
+
+    def make_group(self, ngroup):
+        group = self.grouploader.Groupv2(nrealm=self.api.roster['realm'], ngroup=ngroup,
+                                         groupname=ngroup.title(), password='', visits=4)
+        self.groups.put(group)
+        return group
+
+    def test_flush_adds_visits(self):
+        group = self.make_group('visited')
+        cached = '%s_%s' % (group.nrealm, group.ngroup)
+        self.mc.set(cached, group)
+
+        for i in range(3):
+            self.visits.record_visit(group)
+
+        # Page views don't write the group. The pending groups are kept in
+        # memcache, so the cron job sees the visits from every instance.
+        self.assertEqual(group.visits, 4)
+        pending = self.mc.get(self.visits.PENDING_KEY)
+        self.assertEqual(pending, {(group.nrealm, group.ngroup): group.key})
+        flushed = self.visits.flush()
+
+        self.assertEqual(flushed, {(group.nrealm, group.ngroup): 3})
+        self.assertEqual(group.visits, 7)
+        self.assertIsNotNone(group.lastvisited)
+        self.assertIsNone(self.mc.get(cached))
+        self.assertEqual(self.mc.get(self.visits.counter_key(group.nrealm, group.ngroup)), 0)
+
+        # Nothing new to write, so another flush leaves the count alone.
+        self.assertEqual(self.visits.flush(), {})
+        self.assertEqual(group.visits, 7)
+
+    def test_take_counts_once(self):
+        group = self.make_group('taken')
+        self.visits.record_visit(group)
+        self.visits.record_visit(group)
+
+        name = (group.nrealm, group.ngroup)
+        self.assertEqual(self.visits.take_counts([name]), {name: 2})
+        self.assertEqual(self.visits.take_counts([name]), {})
+
+    def test_flush_writes_in_batches(self):
+        groups = [self.make_group('group%d' % i) for i in range(60)]
+        for group in groups:
+            self.visits.record_visit(group)
+
+        batches = []
+        write_visits = self.visits.write_visits
+        def record_batch(batch):
+            batches.append(len(batch))
+            return write_visits(batch)
+        self.visits.write_visits = record_batch
+        try:
+            flushed = self.visits.flush()
+        finally:
+            self.visits.write_visits = write_visits
+
+        self.assertEqual(len(flushed), 60)
+        self.assertEqual(batches, [25, 25, 10])
+        self.assertTrue(all(g.visits == 5 for g in groups))
+
+if __name__ == '__main__':
+    unittest.main()
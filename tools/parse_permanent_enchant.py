@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+#!/usr/bin/env python
+
+# Updates the enchant ids in gear_rules.json from simc's generated list of
+# permanent enchants, so a new season's enchants are a data update instead of
+# a code change.
+#
+# To generate the list, grab the simc source from github and run these
+# commands:
+# cd casc_extract
+# python3 -m venv venv
+# source venv/bin/activate
+# pip3 install -r requirements.txt
+# python3 casc_extract.py -m batch --cdn -o wow
+#
+# cd ../dbc_extract3
+# python3 -m venv venv
+# source venv/bin/activate
+# pip3 install -r requirements.txt
+# ./generate.sh 11.1.0.59538 ../casc_extract/wow (where the version number
+#      comes from the latest version extracted by casc_extract)
+#
+# Then run this with the path to ../engine/dbc/generated/permanent_enchant.inc
+# and the same version number:
+# python3 tools/parse_permanent_enchant.py permanent_enchant.inc 11.1.0.59538 --write
+#
+# Each entry in permanent_enchant.inc is read as
+# { enchant id, rank, spell id, "tokenized_name" }. Every enchant in the rules
+# file is matched to the entries with the same tokenized name, and its ids
+# are replaced with the ones from the file for each rank. Enchants marked as
+# pinned (ones that count the same at every rank, or that don't have ranks)
+# are left alone, as are any names that aren't found, which are reported.
+
+import os
+import re
+import sys
+import json
+import argparse
+
+ENTRY_RE = re.compile(r'\{\s*(\d+)\s*,\s*(\d+)\s*,\s*(\d+)\s*,\s*"([^"]*)"\s*\}')
+
+RULES_PATH = os.path.join(os.path.split(__file__)[0], '..', 'gear_rules.json')
+
+def tokenize(name):
+    name = name.lower().replace('\'', '')
+    return re.sub(r'[^a-z0-9]+', '_', name).strip('_')
+
+# Returns a dict of tokenized name -> list of (rank, enchant id).
+def parse_inc(path):
+    enchants = {}
+    with open(path) as inc:
+        for match in ENTRY_RE.finditer(inc.read()):
+            enchant_id, rank, spell_id, name = match.groups()
+            enchants.setdefault(tokenize(name), []).append((int(rank), int(enchant_id)))
+    return enchants
+
+def update_rules(rules, enchants, version):
+    missing = []
+    for group, entries in rules['enchants'].items():
+        updated = []
+        done = set()
+        for entry in entries:
+            if entry.get('pinned'):
+                updated.append(entry)
+                continue
+
+            if entry['name'] in done:
+                continue
+
+            found = enchants.get(tokenize(entry['name']))
+            if not found:
+                name = '%s: %s' % (group, entry['name'])
+                if name not in missing:
+                    missing.append(name)
+                updated.append(entry)
+                continue
+
+            done.add(entry['name'])
+            for rank, enchant_id in sorted(set(found)):
+                updated.append({'id': enchant_id, 'rank': rank, 'name': entry['name']})
+
+        # Keep the file ordered by rank like the game data
+        rules['enchants'][group] = sorted(updated, key=lambda e: e['rank'])
+
+    rules['version'] = version
+    return missing
+
+# Writes the rules in the same layout as the checked in file, with one enchant
+# per line so that diffs between seasons are readable.
+def dump_rules(rules):
+    lines = ['{']
+    lines.append('  "version": %s,' % json.dumps(rules['version']))
+    lines.append('  "better_rank": %d,' % rules['better_rank'])
+    lines.append('  "slots": {')
+    slots = ['    %s: %s' % (json.dumps(k), json.dumps(v)) for k, v in rules['slots'].items()]
+    lines.append(',\n'.join(slots))
+    lines.append('  },')
+    lines.append('  "enchants": {')
+    groups = []
+    for group, entries in rules['enchants'].items():
+        body = ',\n'.join('      ' + json.dumps(e) for e in entries)
+        groups.append('    %s: [\n%s\n    ]' % (json.dumps(group), body))
+    lines.append(',\n'.join(groups))
+    lines.append('  },')
+    lines.append('  "tier_sets": %s,' % json.dumps(rules['tier_sets']))
+    lines.append('  "crafted_limit_categories": %s' % json.dumps(rules['crafted_limit_categories']))
+    lines.append('}')
+    return '\n'.join(lines) + '\n'
+
+def main():
+    parser = argparse.ArgumentParser(description='Update gear_rules.json from simc permanent_enchant.inc')
+    parser.add_argument('inc', help='path to permanent_enchant.inc')
+    parser.add_argument('version', help='game build the file was generated from')
+    parser.add_argument('--rules', default=RULES_PATH, help='rules file to update')
+    parser.add_argument('--write', action='store_true', help='write the rules file instead of printing it')
+    args = parser.parse_args()
+
+    with open(args.rules) as rules_file:
+        rules = json.load(rules_file)
+
+    missing = update_rules(rules, parse_inc(args.inc), args.version)
+    for name in missing:
+        print('not found in %s: %s' % (args.inc, name), file=sys.stderr)
+
+    output = dump_rules(rules)
+    if args.write:
+        with open(args.rules, 'w') as rules_file:
+            rules_file.write(output)
+    else:
+        sys.stdout.write(output)
+
+if __name__ == '__main__':
+    main()
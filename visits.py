@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+#!/usr/bin/env python
+
+import logging
+from datetime import datetime
+
+from google.appengine.ext import ndb
+from google.appengine.api import memcache
+
+# How many times to retry a compare-and-set on a memcache entry when another
+# instance changes it at the same time.
+CAS_RETRIES = 5
+
+# The most groups written in one datastore transaction. Cross-group
+# transactions can touch at most 25 entity groups.
+WRITE_BATCH_SIZE = 25
+
+# Tracks visits to group pages without writing the group to the datastore on
+# every page view. Everything is kept in memcache so that the cron job can
+# write out the visits seen by every instance. Each visit bumps a counter and
+# notes the time of the visit, and the first visit to a group since the last
+# flush adds it to the set of pending groups. The /refresh cron job writes the
+# pending groups out in batches before it refreshes any pages, with their
+# lastvisited time and the visits counted since the last flush added to their
+# total. Page views never write to the datastore.
+
+PENDING_KEY = 'visits_pending'
+
+def counter_key(nrealm, ngroup):
+    return 'visits_%s_%s' % (nrealm, ngroup)
+
+def visited_key(nrealm, ngroup):
+    return 'visited_%s_%s' % (nrealm, ngroup)
+
+# Set while a group is in the pending set, so that only the first visit after
+# a flush has to update the set.
+def marker_key(nrealm, ngroup):
+    return 'visitpending_%s_%s' % (nrealm, ngroup)
+
+# Records a visit to a group. The counter, the visit time and the marker are
+# all sent at once, so a page view waits on one round trip to memcache.
+def record_visit(group):
+    client = memcache.Client()
+    marker = marker_key(group.nrealm, group.ngroup)
+    rpcs = [
+        client.offset_multi_async({counter_key(group.nrealm, group.ngroup): 1}, initial_value=0),
+        client.set_multi_async({visited_key(group.nrealm, group.ngroup): datetime.now()}),
+        client.add_multi_async({marker: 1}),
+    ]
+    added = rpcs[2].get_result() or {}
+    for rpc in rpcs[:2]:
+        rpc.get_result()
+
+    if added.get(marker) == memcache.STORED and not add_pending(group):
+        memcache.delete(marker)
+
+# Adds a group to the pending set, which maps (nrealm, ngroup) to the group's
+# datastore key.
+def add_pending(group):
+    client = memcache.Client()
+    for i in range(CAS_RETRIES):
+        pending = client.gets(PENDING_KEY)
+        if pending is None:
+            if memcache.add(PENDING_KEY, {(group.nrealm, group.ngroup): group.key}):
+                return True
+            continue
+
+        pending[(group.nrealm, group.ngroup)] = group.key
+        if client.cas(PENDING_KEY, pending):
+            return True
+
+    logging.warning('failed to add %s/%s to the pending visits' % (group.nrealm, group.ngroup))
+    return False
+
+# Takes the pending set, leaving it empty.
+def take_pending():
+    client = memcache.Client()
+    for i in range(CAS_RETRIES):
+        pending = client.gets(PENDING_KEY)
+        if not pending:
+            return {}
+        if client.cas(PENDING_KEY, {}):
+            return pending
+    return {}
+
+# Returns the number of visits each of the groups has had since they were
+# last written to the datastore, as a dict keyed by (nrealm, ngroup).
+def recent_counts(groups):
+    keys = dict((counter_key(g.nrealm, g.ngroup), (g.nrealm, g.ngroup)) for g in groups)
+    counts = memcache.get_multi(list(keys.keys()))
+    return dict((keys[k], v) for k, v in counts.items())
+
+# Takes the visits counted for a list of (nrealm, ngroup) since they were last
+# written out, leaving their counters at zero. The compare-and-set means two
+# flushes running at once can't both take the same visits. Returns a dict of
+# the counts keyed by (nrealm, ngroup).
+def take_counts(groups):
+    client = memcache.Client()
+    keys = dict((counter_key(nrealm, ngroup), (nrealm, ngroup)) for nrealm, ngroup in groups)
+    counts = {}
+    for i in range(CAS_RETRIES):
+        values = dict((k, v) for k, v in client.get_multi(list(keys), for_cas=True).items() if v)
+        if not values:
+            break
+        failed = client.cas_multi(dict((k, 0) for k in values)) or []
+        for k, v in values.items():
+            if k not in failed:
+                counts[keys[k]] = v
+        keys = dict((k, keys[k]) for k in failed)
+    return counts
+
+# Adds visits to a batch of groups in the datastore. batch is a list of
+# (key, visited, count). The groups are read again inside the transaction and
+# only lastvisited and visits are changed, so a save of a group from the
+# editor can't be lost. Returns the groups that were written.
+@ndb.transactional(xg=True)
+def write_visits(batch):
+    groups = ndb.get_multi([key for key, visited, count in batch])
+    written = []
+    for group, (key, visited, count) in zip(groups, batch):
+        if group is None:
+            continue
+        if visited is not None and (group.lastvisited is None or group.lastvisited < visited):
+            group.lastvisited = visited
+        group.visits = (group.visits or 0) + count
+        written.append(group)
+
+    ndb.put_multi(written)
+    return written
+
+# Writes the pending visits out to the datastore. Returns the number of
+# visits written for each group, as a dict keyed by (nrealm, ngroup).
+def flush():
+    pending = take_pending()
+    if not pending:
+        return {}
+
+    memcache.delete_multi([marker_key(nrealm, ngroup) for nrealm, ngroup in pending])
+    times = memcache.get_multi([visited_key(nrealm, ngroup) for nrealm, ngroup in pending])
+    counts = take_counts(list(pending))
+
+    groups = list(pending.items())
+    written = {}
+    for start in range(0, len(groups), WRITE_BATCH_SIZE):
+        batch = groups[start:start + WRITE_BATCH_SIZE]
+        try:
+            for group in write_visits([(key, times.get(visited_key(*name)), counts.get(name, 0))
+                                       for name, key in batch]):
+                name = (group.nrealm, group.ngroup)
+                written[name] = counts.get(name, 0)
+        except Exception:
+            logging.exception('failed to write visits for %d groups' % len(batch))
+            memcache.offset_multi(dict((counter_key(*name), counts[name])
+                                       for name, key in batch if counts.get(name)),
+                                  initial_value=0)
+
+    # The copies of the groups that Groupv2.query_group loads from memcache
+    # are out of date now. They're dropped rather than replaced, so a newer
+    # copy cached by a save isn't overwritten.
+    if written:
+        memcache.delete_multi(['%s_%s' % group for group in written])
+
+    logging.info('wrote visits for %d groups' % len(written))
+    return written
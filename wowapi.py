@@ -4,45 +4,413 @@
 import json
 import time
 import os
+import heapq
+import random
 import base64
 import urllib
 import logging
+import threading
 import requests
 
-from concurrent.futures import as_completed
-from requests_futures.sessions import FuturesSession
+from collections import namedtuple, deque
+from datetime import timedelta
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError, as_completed, wait
 from google.appengine.ext import ndb
 from google.appengine.api import memcache
 
-def get_oauth_headers():
-    oauth_token = memcache.get('oauth_bearer_token')
-    if oauth_token is None:
+import metrics
+import ratelimit
+from characters import CharacterSnapshot, SNAPSHOT_VERSION, parse_profile, parse_equipment
+
+# Size of the worker pool and of the keep-alive connection pool shared by all
+# of the calls to the Blizzard API from this instance.
+API_POOL_SIZE = 20
+
+# Connect and read timeouts for calls to the Blizzard API, in seconds.
+API_TIMEOUT = (3.05, 10)
+
+# Calls that time out, fail to connect, or get one of the RETRY_STATUSES back
+# are retried up to API_RETRIES times. The wait before retry n is random,
+# between zero and API_RETRY_BACKOFF * 2^n seconds.
+API_RETRIES = 2
+API_RETRY_BACKOFF = 0.1
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+# A call that hasn't finished after the HEDGE_PERCENTILE latency of recent
+# calls gets a second, identical request, and whichever finishes first is
+# used. Until there are HEDGE_MIN_SAMPLES latencies to go on, the delay is
+# HEDGE_DEFAULT_DELAY. Hedges are only sent when the rate limiter has room,
+# and are limited to HEDGE_BUDGET of all calls.
+HEDGE_PERCENTILE = 95
+HEDGE_SAMPLES = 500
+HEDGE_MIN_SAMPLES = 20
+HEDGE_DEFAULT_DELAY = 1.0
+HEDGE_MIN_DELAY = 0.1
+HEDGE_BUDGET = 0.1
+
+# How long before the bearer token expires that requests start refreshing it
+# in the background.
+TOKEN_REFRESH_MARGIN = 10 * 60
+
+# How long one instance can hold the lock for requesting a new token from
+# Blizzard, and how long an instance that has no token at all waits for
+# another instance's request to finish before making its own.
+TOKEN_LOCK_TIME = 30
+TOKEN_WAIT_TIME = 5
+
+# How long to wait between attempts at a background refresh.
+TOKEN_RETRY_TIME = 10
+
+# Keeps the bearer token for the Blizzard API in memory and gets a new one
+# before it expires. Once a token is within TOKEN_REFRESH_MARGIN of expiring,
+# the next request starts a refresh on a background thread and keeps using
+# the current token, so requests only wait on a token when there isn't a
+# valid one at all. Only one thread in the instance refreshes at a time, and
+# a lock in memcache keeps the instances from all asking Blizzard at once:
+# the instance holding it requests the token and puts it in memcache, where
+# the rest pick it up.
+class TokenManager(object):
+
+    CACHE_KEY = 'oauth_bearer_token'
+    LOCK_KEY = 'oauth_bearer_token_lock'
+
+    def __init__(self, session):
+        self.session = session
+        self.credentials = self.load_credentials()
+
+        self.token = None
+        self.expires = 0
+
+        # Held while loading a token that requests are waiting on
+        self.lock = threading.Lock()
+
+        # Guards the state of the background refresh
+        self.refresh_lock = threading.Lock()
+        self.refreshing = False
+        self.next_refresh = 0
+
+    # Reads the client id and secret once, and returns the value for the
+    # Authorization header used to request tokens.
+    @staticmethod
+    def load_credentials():
         path = os.path.join(os.path.split(__file__)[0], 'api-auth.json')
-        authdata = json.load(open(path))
+        try:
+            with open(path) as f:
+                authdata = json.load(f)
+        except (IOError, ValueError) as e:
+            logging.error('failed to load api credentials: %s' % e)
+            return None
 
         credentials = "{}:{}".format(authdata['blizzard_client_id'], authdata['blizzard_client_secret'])
         encoded_credentials = base64.b64encode(credentials.encode('ascii')).decode('ascii')
-        headers = {'Authorization': f'Basic {encoded_credentials}'}
-
-        r = requests.post('https://us.battle.net/oauth/token',
-                          data={'grant_type': 'client_credentials'},
-                          headers=headers)
-
-        if r.status_code == 200:
-            response_data = r.json()
-            oauth_token = response_data['access_token']
-
-            # Blizzard sends an expiration time for the token in the response,
-            # but we want to make sure that our memcache expires before they
-            # do. Subtract 60s off that so we make sure to re-request before
-            # it expires.
-            expiration = int(response_data['expires_in']) - 60
-            memcache.set('oauth_bearer_token', oauth_token, time=expiration)
-
-    if oauth_token is None:
-        return {}
-
-    return {'Authorization': 'Bearer ' + oauth_token}
+        return f'Basic {encoded_credentials}'
+
+    # Returns the headers needed to authenticate with the API. This makes
+    # memcache calls when the token needs loading, so it should only be
+    # called from a request thread.
+    def headers(self):
+        token = self.token
+        remaining = self.expires - time.time()
+
+        if token is None or remaining <= 0:
+            with self.lock:
+                if self.token is None or time.time() >= self.expires:
+                    self.token, self.expires = self.load(wait=True)
+                token = self.token
+        elif remaining < TOKEN_REFRESH_MARGIN:
+            self.refresh_in_background()
+
+        if token is None:
+            return {}
+
+        return {'Authorization': 'Bearer ' + token}
+
+    # Starts a thread to get a new token, unless one is already running or
+    # the last attempt was too recent. Threads started from a request can
+    # still make memcache calls.
+    def refresh_in_background(self):
+        with self.refresh_lock:
+            if self.refreshing or time.time() < self.next_refresh:
+                return
+            self.refreshing = True
+            self.next_refresh = time.time() + TOKEN_RETRY_TIME
+
+        def refresh():
+            try:
+                token, expires = self.load(wait=False)
+                with self.lock:
+                    if token is not None and expires > self.expires:
+                        self.token, self.expires = token, expires
+            except Exception:
+                logging.exception('failed to refresh the api token')
+            finally:
+                with self.refresh_lock:
+                    self.refreshing = False
+
+        threading.Thread(target=refresh).start()
+
+    # Returns a new (token, expires) pair, or (None, 0) if there isn't one.
+    # A token in memcache is used if it's not about to expire. Otherwise the
+    # token is requested from Blizzard by whichever instance gets the lock.
+    # If another instance has it, a background refresh gives up and tries
+    # again later, but when wait is set this polls memcache for the other
+    # instance's token for up to TOKEN_WAIT_TIME seconds first.
+    def load(self, wait):
+        cached = memcache.get(TokenManager.CACHE_KEY)
+        usable_until = time.time() if wait else time.time() + TOKEN_REFRESH_MARGIN
+        if isinstance(cached, tuple) and cached[1] > usable_until:
+            return cached
+
+        if memcache.add(TokenManager.LOCK_KEY, 1, time=TOKEN_LOCK_TIME):
+            try:
+                return self.request_token()
+            finally:
+                memcache.delete(TokenManager.LOCK_KEY)
+
+        if not wait:
+            return None, 0
+
+        deadline = time.time() + TOKEN_WAIT_TIME
+        while time.time() < deadline:
+            time.sleep(0.1)
+            cached = memcache.get(TokenManager.CACHE_KEY)
+            if isinstance(cached, tuple) and cached[1] > time.time():
+                return cached
+
+        logging.warning('timed out waiting for another instance to request an api token')
+        return self.request_token()
+
+    def request_token(self):
+        if self.credentials is None:
+            return None, 0
+
+        # This runs with the token lock held, so it gets the same timeouts as
+        # the API calls rather than holding up every request that needs a
+        # token.
+        try:
+            r = self.session.post('https://us.battle.net/oauth/token',
+                                  data={'grant_type': 'client_credentials'},
+                                  headers={'Authorization': self.credentials},
+                                  timeout=API_TIMEOUT)
+        except requests.RequestException as e:
+            logging.error('failed to request an api token: %s' % e)
+            return None, 0
+
+        if r.status_code != 200:
+            logging.error('failed to get an api token: %d' % r.status_code)
+            return None, 0
+
+        response_data = r.json()
+        oauth_token = response_data['access_token']
+
+        # Blizzard sends an expiration time for the token in the response,
+        # but we want to make sure that our memcache expires before they
+        # do. Subtract 60s off that so we make sure to re-request before
+        # it expires.
+        expiration = int(response_data['expires_in']) - 60
+        expires = time.time() + expiration
+        memcache.set(TokenManager.CACHE_KEY, (oauth_token, expires), time=expiration)
+        logging.info('requested a new api token')
+        return oauth_token, expires
+
+# A long-lived client for the Blizzard API, shared by every request handled by
+# this instance. It keeps a pool of keep-alive connections so calls don't pay
+# for a new TCP/TLS handshake each time, runs asynchronous requests on a
+# shared worker pool, and holds the current bearer token in memory so most
+# calls don't need a memcache lookup to authenticate. Use get_client() to get
+# the shared instance.
+class ApiClient(object):
+
+    def __init__(self, pool_size=API_POOL_SIZE):
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.executor = ThreadPoolExecutor(max_workers=pool_size)
+        self.tokens = TokenManager(self.session)
+
+        # Recent latencies and the hedge delay computed from them
+        self.latencies = deque(maxlen=HEDGE_SAMPLES)
+        self.hedge_delay = HEDGE_DEFAULT_DELAY
+        self.stats_lock = threading.Lock()
+
+        # Counts of the calls made and the hedges among them, and the calls
+        # beyond the ones requested (retries and hedges) that haven't been
+        # claimed in the shared rate limit yet
+        self.calls = 0
+        self.hedges = 0
+        self.extra_calls = 0
+
+        # Hedges waiting for their delay, as a heap of (time, seq, request),
+        # and the thread that sends them
+        self.pending_hedges = []
+        self.hedge_seq = 0
+        self.hedge_cond = threading.Condition()
+        self.hedge_thread = None
+
+    # Returns the headers needed to authenticate with the API. This should
+    # only be called from a request thread.
+    def oauth_headers(self):
+        with metrics.current().phase('oauth'):
+            return self.tokens.headers()
+
+    # Makes a GET request on the calling thread, waiting for the rate
+    # limiter before each attempt. Failed attempts are retried after a
+    # jittered backoff. The response's elapsed time is replaced with the time
+    # for the whole request including the body, but not the waits. If
+    # started is given, it's called when the first attempt is sent.
+    def get(self, url, headers, started=None):
+        attempt = 0
+        while True:
+            ratelimit.limiter.acquire()
+            if started is not None and attempt == 0:
+                started()
+            start = time.time()
+            try:
+                response = self.session.get(url, headers=headers, timeout=API_TIMEOUT)
+            except (requests.Timeout, requests.ConnectionError) as e:
+                if attempt >= API_RETRIES:
+                    raise
+                logging.warning('retrying %s after %s' % (url, type(e).__name__))
+            else:
+                response.elapsed = timedelta(seconds=time.time() - start)
+                if response.status_code not in RETRY_STATUSES:
+                    self.record_latency(response.elapsed.total_seconds())
+                    return response
+                if attempt >= API_RETRIES:
+                    return response
+                logging.warning('retrying %s after a %d' % (url, response.status_code))
+
+            attempt += 1
+            self.add_extra_call()
+            time.sleep(random.uniform(0, API_RETRY_BACKOFF * 2 ** attempt))
+
+    # Queues a GET request on the worker threads and returns its future. The
+    # worker waits for the rate limiter before making the request. If the
+    # request is still running after the hedge delay, counted from when it
+    # was actually sent, a hedge is sent.
+    def submit(self, url, headers):
+        request = HedgedRequest(self, url, headers)
+        request.send(lambda: self.schedule_hedge(request))
+        return request.result
+
+    def record_latency(self, seconds):
+        with self.stats_lock:
+            self.latencies.append(seconds)
+
+            # Sorting the samples on every call isn't worth it, so the delay
+            # is only recomputed every so often.
+            if len(self.latencies) >= HEDGE_MIN_SAMPLES and len(self.latencies) % 10 == 0:
+                values = sorted(self.latencies)
+                idx = min(len(values) - 1, len(values) * HEDGE_PERCENTILE // 100)
+                self.hedge_delay = max(HEDGE_MIN_DELAY, values[idx])
+
+    def add_extra_call(self):
+        with self.stats_lock:
+            self.extra_calls += 1
+
+    # Returns the number of retries and hedges since the last call, so they
+    # can be claimed in the shared rate limit from a request thread.
+    def take_extra_calls(self):
+        with self.stats_lock:
+            extra, self.extra_calls = self.extra_calls, 0
+            return extra
+
+    # Returns whether a hedge can be sent now without going over the hedge
+    # budget or having to wait on the rate limiter.
+    def allow_hedge(self):
+        with self.stats_lock:
+            if self.hedges >= self.calls * HEDGE_BUDGET:
+                return False
+            if ratelimit.limiter.wait_time() > 0:
+                return False
+            self.hedges += 1
+            self.extra_calls += 1
+            return True
+
+    def schedule_hedge(self, request):
+        with self.hedge_cond:
+            self.calls += 1
+            self.hedge_seq += 1
+            heapq.heappush(self.pending_hedges, (time.time() + self.hedge_delay, self.hedge_seq, request))
+            self.hedge_cond.notify()
+
+            if self.hedge_thread is None:
+                self.hedge_thread = threading.Thread(target=self.run_hedges, daemon=True)
+                self.hedge_thread.start()
+
+    # Sends the hedges for requests that are still running once their delay
+    # is up. This only hands work to the workers, so it can run on a thread
+    # that outlives the request that started it.
+    def run_hedges(self):
+        while True:
+            with self.hedge_cond:
+                while not self.pending_hedges:
+                    self.hedge_cond.wait()
+
+                when, seq, request = self.pending_hedges[0]
+                now = time.time()
+                if when > now:
+                    self.hedge_cond.wait(when - now)
+                    continue
+                heapq.heappop(self.pending_hedges)
+
+            if not request.result.done() and self.allow_hedge():
+                logging.info('sending a hedge request for %s' % request.url)
+                request.send()
+
+# A GET request that can be sent more than once. The result future gets the
+# first response to arrive. If an attempt fails while another is still
+# running, the other one gets the chance to succeed.
+class HedgedRequest(object):
+
+    def __init__(self, client, url, headers):
+        self.client = client
+        self.url = url
+        self.headers = headers
+        self.result = Future()
+        self.running = 0
+        self.finished = False
+        self.lock = threading.Lock()
+
+    def send(self, started=None):
+        with self.lock:
+            if self.finished:
+                return
+            self.running += 1
+        self.client.executor.submit(self.client.get, self.url, self.headers,
+                                    started).add_done_callback(self.done)
+
+    def done(self, future):
+        with self.lock:
+            self.running -= 1
+            if self.finished:
+                return
+            if future.exception() is not None and self.running > 0:
+                return
+            self.finished = True
+
+        if future.exception() is not None:
+            self.result.set_exception(future.exception())
+        else:
+            self.result.set_result(future.result())
+
+_client = None
+_client_lock = threading.Lock()
+
+# Returns the URL for a toon's profile, which also identifies the toon in
+# the character cache.
+def character_url(realm, name):
+    quoted_name = urllib.parse.quote(name.encode('utf-8').lower())
+    return f'https://us.api.blizzard.com/profile/wow/character/{realm}/{quoted_name}?namespace=profile-us&locale=en_US'
+
+# Returns the ApiClient shared by this instance, creating it the first time.
+def get_client():
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = ApiClient()
+    return _client
 
 class ClassEntry(ndb.Model):
     classId = ndb.IntegerProperty()
@@ -66,235 +434,259 @@ class Realm(ndb.Model):
             return result.realm
         return ''
 
-class Importer(object):
+# Holds the last profile and equipment data seen for each toon, keyed by the
+# toon's profile URL, along with the ETag/Last-Modified validators that
+# Blizzard sent with them. The data is stored in the compact form from the
+# characters module rather than as the raw json. Requests for a toon that's in
+# the cache are made conditional, and a 304 from Blizzard reuses the cached
+# data instead of transferring and parsing the whole thing again. All of the
+# entries for a page load are read with one memcache call up front and the
+# changed ones are written back at the end, so the worker threads making the
+# requests never touch memcache.
+#
+# Toons whose profile request got a 404 or 403 are also remembered, under a
+# separate prefix and for a much shorter time, so a renamed or deleted toon
+# isn't requested again on every view of its group.
+#
+# The last complete profile and equipment data for each toon is kept as well,
+# with the time it was loaded. A page that can't get a toon's data from
+# Blizzard, because the requests failed or didn't finish in time, shows this
+# copy instead of an error. It's only rewritten once it's LAST_GOOD_INTERVAL
+# old, so the time shown with it can be up to that far behind.
+class CharacterCache(object):
+
+    KEY_PREFIX = 'charcache_%s_' % SNAPSHOT_VERSION
+    MISSING_PREFIX = 'charmissing_'
+    LAST_GOOD_PREFIX = 'charlastgood_%s_' % SNAPSHOT_VERSION
+    MISSING_STATUSES = (403, 404)
+
+    # Cached data is only reused after Blizzard confirms it hasn't changed, so
+    # it can stick around for a long time.
+    EXPIRATION = 7 * 24 * 60 * 60
+    MISSING_EXPIRATION = 2 * 60 * 60
+    LAST_GOOD_EXPIRATION = 30 * 24 * 60 * 60
+    LAST_GOOD_INTERVAL = 10 * 60
+
+    def __init__(self, urls):
+        keys = [CharacterCache.KEY_PREFIX + url for url in urls]
+        keys += [CharacterCache.MISSING_PREFIX + url for url in urls]
+        keys += [CharacterCache.LAST_GOOD_PREFIX + url for url in urls]
+        cached = memcache.get_multi(keys) or {}
+
+        self.entries = {}
+        self.missing = {}
+        self.last_good = {}
+        for url in urls:
+            if CharacterCache.KEY_PREFIX + url in cached:
+                self.entries[url] = cached[CharacterCache.KEY_PREFIX + url]
+            if CharacterCache.MISSING_PREFIX + url in cached:
+                self.missing[url] = cached[CharacterCache.MISSING_PREFIX + url]
+            if CharacterCache.LAST_GOOD_PREFIX + url in cached:
+                self.last_good[url] = cached[CharacterCache.LAST_GOOD_PREFIX + url]
+
+        self.updated = set()
+        self.new_missing = {}
+        self.new_last_good = {}
+        self.lock = threading.Lock()
+
+    # Clears the remembered 404s and 403s for a list of profile URLs, so the
+    # toons are requested again.
+    @staticmethod
+    def forget_missing(urls):
+        memcache.delete_multi(urls, key_prefix=CharacterCache.MISSING_PREFIX)
+
+    # Returns a copy of the request headers with the validators for the
+    # cached response added, if there is one.
+    def request_headers(self, url, phase, headers):
+        entry = self.entries.get(url, {}).get(phase)
+        if not entry:
+            return headers
+
+        headers = dict(headers)
+        if entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+    # Returns the data for a response. Good responses are parsed and passed
+    # through compact, and the result is stored for the next request if it
+    # came with validators. Anything else is returned as the raw json. A 304
+    # is answered from the cache and the response's status is changed to the
+    # 200 it stands in for, so the rest of the importer doesn't need to know
+    # the difference.
+    def parse(self, url, phase, response, compact):
+        if response.status_code == 304:
+            entry = self.entries.get(url, {}).get(phase)
+            if entry is not None:
+                response.status_code = 200
+                return entry['data']
+
+        jsondata = response.json()
+        if phase == 'profile' and response.status_code in CharacterCache.MISSING_STATUSES:
+            with self.lock:
+                self.new_missing[url] = (response.status_code, jsondata)
+
+        if response.status_code != 200 or ('code' in jsondata and 'detail' in jsondata):
+            return jsondata
+
+        jsondata = compact(jsondata)
+
+        etag = response.headers.get('ETag')
+        last_modified = response.headers.get('Last-Modified')
+        if etag or last_modified:
+            with self.lock:
+                entry = dict(self.entries.get(url, {}))
+                entry[phase] = {
+                    'etag': etag,
+                    'last_modified': last_modified,
+                    'data': jsondata,
+                }
+                self.entries[url] = entry
+                self.updated.add(url)
+
+        return jsondata
+
+    # Keeps the data from a complete load of a toon as its last good copy.
+    def remember(self, url, profile, items):
+        entry = self.last_good.get(url)
+        if entry is not None and time.time() - entry['time'] < CharacterCache.LAST_GOOD_INTERVAL:
+            return
+        with self.lock:
+            self.new_last_good[url] = self.last_good[url] = last_good_entry(profile, items)
+
+    # Writes the changes to memcache. Loads that are still running can keep
+    # adding to the cache while this runs, and are picked up by a later call,
+    # which can come from the thread saving late results.
+    def save(self):
+        with self.lock:
+            updates = dict((url, self.entries[url]) for url in self.updated)
+            self.updated.clear()
+            new_missing = self.new_missing
+            self.new_missing = {}
+            new_last_good = self.new_last_good
+            self.new_last_good = {}
+
+        if updates:
+            memcache.set_multi(updates, key_prefix=CharacterCache.KEY_PREFIX,
+                               time=CharacterCache.EXPIRATION)
+
+        if new_missing:
+            memcache.set_multi(new_missing, key_prefix=CharacterCache.MISSING_PREFIX,
+                               time=CharacterCache.MISSING_EXPIRATION)
+
+        if new_last_good:
+            memcache.set_multi(new_last_good, key_prefix=CharacterCache.LAST_GOOD_PREFIX,
+                               time=CharacterCache.LAST_GOOD_EXPIRATION)
+
+def last_good_entry(profile, items):
+    return {'time': time.time(), 'profile': profile, 'items': items}
+
+RealmInfo = namedtuple('RealmInfo', ['slug', 'realm'])
+
+# An in-memory copy of the realm and class lists, with hash indexes for the
+# lookups the page handlers need. Each copy is stamped with the version it was
+# loaded at. The current version lives in memcache and /initdb bumps it, which
+# makes every instance reload its copy on its next request. The lists for each
+# version are also stored in memcache, so a reload normally doesn't touch the
+# datastore either. Use get_reference_data() to get the current copy.
+class ReferenceData(object):
+
+    VERSION_KEY = 'refdata_version'
+    DATA_KEY = 'refdata_%s'
+
+    def __init__(self, version, realms, classes):
+        self.version = version
+
+        # List of RealmInfo in the order the datastore returns them, for
+        # building the realm selectors.
+        self.realms = realms
+
+        # slug -> full realm name, and name -> slug
+        self.realm_names = dict((r.slug, r.realm) for r in realms)
+        self.realm_slugs = dict((r.realm, r.slug) for r in realms)
+
+        # class id -> class name
+        self.class_names = classes
 
-    # Each quality rank has its own list to allow for adjusting whether
-    # low-rank enchants count as lesser enchants or not. These spell numbers
-    # don't come from wowhead, but from the game data itself. I don't see
-    # how to generate them from the HTTP API, but they can be extracted from
-    # the game data itself.
-    #
-    # To do so, grab the simc source from github and run these commands:
-    # cd casc_extract
-    # python3 -m venv venv
-    # source venv/bin/activate
-    # pip3 install -r requirements.txt
-    # python3 casc_extract.py -m batch --cdn -o wow
-    #
-    # cd ../dbc_extract3
-    # python3 -m venv venv
-    # source venv/bin/activate
-    # pip3 install -r requirements.txt
-    # ./generate.sh 11.1.0.59538 ../casc_extract/wow (where the version number
-    #      comes from the latest version extracted by casc_extract)
-    #
-    # cat ../engine/dbc/generated/permanent_enchant.inc
-
-    WEAPON_ENCHANTS_R1 = [
-        7449, # Authority of Air (Rank 1)
-        7452, # Authority of Fiery Resolve (Rank 1)
-        7461, # Authority of Radiant Power (Rank 1)
-        7455, # Authority of Storms (Rank 1)
-        7458, # Authority of the Depths (Rank 1)
-        7437, # Council's Guile (Rank 1)
-        7446, # Oathsworn's Tenacity (Rank 1)
-        7443, # Stonebound Artistry (Rank 1)
-        7440, # Stormrider's Fury (Rank 1)
-    ]
-
-    WEAPON_ENCHANTS_R2 = [
-        7450, # Authority of Air (Rank 2)
-        7453, # Authority of Fiery Resolve (Rank 2)
-        7462, # Authority of Radiant Power (Rank 2)
-        7456, # Authority of Storms (Rank 2)
-        7459, # Authority of the Depths (Rank 2)
-        7438, # Council's Guile (Rank 2)
-        7447, # Oathsworn's Tenacity (Rank 2)
-        7444, # Stonebound Artistry (Rank 2)
-        7441, # Stormrider's Fury (Rank 2)
-    ]
-
-    WEAPON_ENCHANTS_R3 = [
-        7451, # Authority of Air (Rank 3)
-        7453, # Authority of Fiery Resolve (Rank 3)
-        7463, # Authority of Radiant Power (Rank 3)
-        7457, # Authority of Storms (Rank 3)
-        7460, # Authority of the Depths (Rank 3)
-        7439, # Council's Guile (Rank 3)
-        7448, # Oathsworn's Tenacity (Rank 3)
-        7445, # Stonebound Artistry (Rank 3)
-        7442, # Stormrider's Fury (Rank 3)
-    ]
-
-    DEATH_KNIGHT_RUNEFORGES = [
-        3368, # Fallen Crusader
-        3380, # Razorice
-        6241, # Sanguination
-        6243, # Hysteria
-    ]
-
-    BRACER_ENCHANTS_R1 = [
-        7383, # Chant of Armored Avoidance (Rank 1)
-        7389, # Chant of Armored Leech (Rank 1)
-        7395, # Chant of Armored Speed (Rank 1)
-    ]
-
-    BRACER_ENCHANTS_R2 = [
-        7384, # Chant of Armored Avoidance (Rank 2)
-        7390, # Chant of Armored Leech (Rank 2)
-        7396, # Chant of Armored Speed (Rank 2)
-    ]
-
-    BRACER_ENCHANTS_R3 = [
-        7385, # Chant of Armored Avoidance (Rank 3)
-        7391, # Chant of Armored Leech (Rank 3)
-        7397, # Chant of Armored Speed (Rank 3)
-    ]
-
-    RING_ENCHANTS_R1 = [
-        7332, # Radiant Critical Strike (Rank 1)
-        7338, # Radiant Haste (Rank 1)
-        7344, # Radiant Mastery (Rank 1)
-        7350, # Radiant Versatility (Rank 1)
-        7468, # Cursed Critical Strike (Rank 1)
-        7471, # Cursed Haste (Rank 1)
-        7477, # Cursed Mastery (Rank 1)
-        7474, # Cursed Versatility (Rank 1)
-    ]
-
-    RING_ENCHANTS_R2 = [
-        7333, # Radiant Critical Strike (Rank 2)
-        7339, # Radiant Haste (Rank 2)
-        7345, # Radiant Mastery (Rank 2)
-        7351, # Radiant Versatility (Rank 2)
-        7469, # Cursed Critical Strike (Rank 2)
-        7472, # Cursed Haste (Rank 2)
-        7478, # Cursed Mastery (Rank 2)
-        7475, # Cursed Versatility (Rank 2)
-    ]
-
-    RING_ENCHANTS_R3 = [
-        7334, # Radiant Critical Strike (Rank 3)
-        7340, # Radiant Haste (Rank 3)
-        7346, # Radiant Mastery (Rank 3)
-        7352, # Radiant Versatility (Rank 3)
-        7470, # Cursed Critical Strike (Rank 3)
-        7473, # Cursed Haste (Rank 3)
-        7479, # Cursed Mastery (Rank 3)
-        7476, # Cursed Versatility (Rank 3)
-    ]
-
-    CLOAK_ENCHANTS_R1 = [
-        7413, # Chant of Burrowing Rapidity (Rank 1)
-        7407, # Chant of Leeching Fangs (Rank 1)
-        7401, # Chant of Winged Grace (Rank 1)
-    ]
-
-    CLOAK_ENCHANTS_R2 = [
-        7414, # Chant of Burrowing Rapidity (Rank 2)
-        7408, # Chant of Leeching Fangs (Rank 2)
-        7402, # Chant of Winged Grace (Rank 2)
-    ]
-
-    CLOAK_ENCHANTS_R3 = [
-        7415, # Chant of Burrowing Rapidity (Rank 3)
-        7409, # Chant of Leeching Fangs (Rank 3)
-        7403, # Chant of Winged Grace (Rank 3)
-    ]
-
-    LEG_ENCHANTS_R1 = [
-        7652, # Charged Armor Kit (Rank 1)
-        7599, # Stormbound Armor Kit (Rank 1)
-        7593, # Defender's Armor Kit (Rank 1)
-        7532, # Sunset Spellthread (Rank 1)
-        7529, # Daybreak Spellthread (Rank 1)
-        7535, # Weavercloth Spellthread (All ranks)
-        7536,
-        7537,
-        7596, # Dual Layered Armor Kit (All ranks)
-        7597,
-        7598,
-    ]
-
-    LEG_ENCHANTS_R2 = [
-        7653, # Charged Armor Kit (Rank 2)
-        7600, # Stormbound Armor Kit (Rank 2)
-        7594, # Defender's Armor Kit (Rank 2)
-        7533, # Sunset Spellthread (Rank 2)
-        7530, # Daybreak Spellthread (Rank 2)
-    ]
-
-    LEG_ENCHANTS_R3 = [
-        7654, # Charged Armor Kit (Rank 3)
-        7601, # Stormbound Armor Kit (Rank 3)
-        7595, # Defender's Armor Kit (Rank 3)
-        7534, # Sunset Spellthread (Rank 3)
-        7531, # Daybreak Spellthread (Rank 3)
-    ]
-
-    CHEST_ENCHANTS_R1 = [
-        7437, # Council's Intellect (Rank 1)
-        7359, # Oathsworn's Strength (Rank 1)
-        7353, # Stormrider's Agility (Rank 1)
-        7362, # Crystalline Radiance (Rank 1)
-    ]
-
-    CHEST_ENCHANTS_R2 = [
-        7438, # Council's Intellect (Rank 2)
-        7360, # Oathsworn's Strength (Rank 2)
-        7354, # Stormrider's Agility (Rank 2)
-        7363, # Crystalline Radiance (Rank 2)
-    ]
-
-    CHEST_ENCHANTS_R3 = [
-        7439, # Council's Intellect (Rank 3)
-        7361, # Oathsworn's Strength (Rank 3)
-        7355, # Stormrider's Agility (Rank 3)
-        7364, # Crystalline Radiance (Rank 3)
-    ]
-
-    FEET_ENCHANTS_R1 = [
-        7419, # Cavalry's March (Rank 1)
-        7422, # Defender's March (Rank 1)
-        7416, # Scout's March (Rank 1)
-    ]
-
-    FEET_ENCHANTS_R2 = [
-        7420, # Cavalry's March (Rank 2)
-        7423, # Defender's March (Rank 2)
-        7417, # Scout's March (Rank 2)
-    ]
-
-    FEET_ENCHANTS_R3 = [
-        7421, # Cavalry's March (Rank 3)
-        7424, # Defender's March (Rank 3)
-        7418, # Scout's March (Rank 3)
-    ]
-
-    # Join the lists that will be considered "Lesser" enchants
-    ENCHANTS = {
-        'CHEST': CHEST_ENCHANTS_R1 + CHEST_ENCHANTS_R2,
-        'BACK': CLOAK_ENCHANTS_R1 + CLOAK_ENCHANTS_R2,
-        'WRIST': BRACER_ENCHANTS_R1 + BRACER_ENCHANTS_R2,
-        'LEGS': LEG_ENCHANTS_R1 + LEG_ENCHANTS_R2,
-        'FEET': FEET_ENCHANTS_R1 + FEET_ENCHANTS_R2,
-        'FINGER_1': RING_ENCHANTS_R1 + RING_ENCHANTS_R2,
-        'FINGER_2': RING_ENCHANTS_R1 + RING_ENCHANTS_R2,
-        'MAIN_HAND': WEAPON_ENCHANTS_R1 + WEAPON_ENCHANTS_R2,
-        'OFF_HAND': WEAPON_ENCHANTS_R1 + WEAPON_ENCHANTS_R2
-    }
+    @classmethod
+    def load(cls, version):
+        key = ReferenceData.DATA_KEY % version
+        data = memcache.get(key)
+        if data is None:
+            logging.info('reference data version %s was not in memcache' % version)
+            realms = [(x.slug, x.realm) for x in Realm.query(namespace='Realms').fetch()]
+            data = {
+                'realms': realms,
+                'classes': ClassEntry.get_mapping(),
+            }
+            memcache.set(key, data)
+
+        return cls(version, [RealmInfo(*x) for x in data['realms']], data['classes'])
+
+    # Starts a new version of the reference data. Called after the realm and
+    # class lists in the datastore change.
+    @staticmethod
+    def bump():
+        return memcache.incr(ReferenceData.VERSION_KEY, initial_value=int(time.time() * 1000))
+
+_refdata = None
+_refdata_lock = threading.Lock()
+
+# Returns the current reference data, reloading this instance's copy if the
+# version in memcache has moved on from it. This costs one memcache read when
+# nothing has changed.
+def get_reference_data():
+    global _refdata
+
+    with metrics.current().phase('refdata'):
+        version = memcache.get(ReferenceData.VERSION_KEY)
+        if version is None:
+            # The version was evicted (or never set). Start a new one, unless
+            # another instance beat us to it.
+            version = int(time.time() * 1000)
+            if not memcache.add(ReferenceData.VERSION_KEY, version):
+                version = memcache.get(ReferenceData.VERSION_KEY) or version
+
+        with _refdata_lock:
+            if _refdata is None or _refdata.version != version:
+                _refdata = ReferenceData.load(version)
+            return _refdata
+
+# Loads of toons that are in progress on this instance, as a dict of profile
+# URL to the future that gets the result.
+_inflight = {}
+_inflight_lock = threading.Lock()
+
+# Loads that a page gave up on at its deadline are waited on by a thread
+# started from the request, which saves their results once they finish. The
+# workers can't use memcache, but threads started from a request can. Loads
+# that take longer than LATE_RESULT_TIMEOUT seconds aren't waited on.
+LATE_RESULT_TIMEOUT = 60
+
+def save_late_results(cache, urls):
+    def save():
+        try:
+            done, not_done = wait(list(urls), timeout=LATE_RESULT_TIMEOUT)
+            results = {}
+            for future in done:
+                result = future.result()
+                if Importer.is_complete(result):
+                    results[urls[future]] = last_good_entry(result[1], result[3])
+
+            if results:
+                logging.info('saving %d toons that finished loading late' % len(results))
+                memcache.set_multi(results, key_prefix=CharacterCache.LAST_GOOD_PREFIX,
+                                   time=CharacterCache.LAST_GOOD_EXPIRATION)
+            if not_done:
+                logging.warning('gave up waiting on %d late toon loads' % len(not_done))
+            cache.save()
+        except Exception:
+            logging.exception('failed to save late toon loads')
+
+    threading.Thread(target=save).start()
 
-    BETTER_ENCHANTS = {
-        'CHEST': CHEST_ENCHANTS_R3,
-        'BACK': CLOAK_ENCHANTS_R3,
-        'WRIST': BRACER_ENCHANTS_R3,
-        'LEGS': LEG_ENCHANTS_R3,
-        'FEET': FEET_ENCHANTS_R3,
-        'FINGER_1': RING_ENCHANTS_R3,
-        'FINGER_2': RING_ENCHANTS_R3,
-        'MAIN_HAND': WEAPON_ENCHANTS_R3 + DEATH_KNIGHT_RUNEFORGES,
-        'OFF_HAND': WEAPON_ENCHANTS_R3
-    }
+class Importer(object):
 
     CLASS_ARMOR = {
         'Death Knight': 'plate',
@@ -312,200 +704,359 @@ class Importer(object):
         'Warrior': 'plate'
     }
 
-    def load(self, realm, frealm, toonlist, data, groupstats):
+    # Loads the data for every toon in toonlist into data and groupstats.
+    #
+    # If deadline is given, the load stops waiting on Blizzard that many
+    # seconds after it started. Toons that haven't finished loading by then
+    # are filled in from their last good data, marked with the time it was
+    # loaded, and the loads keep running in the background to update it.
+    # The number of toons that missed the deadline is left in self.late.
+    def load(self, realm, frealm, toonlist, data, groupstats, refdata=None, deadline=None):
+        for toondata in self.iter_load(realm, frealm, toonlist, data, groupstats, refdata, deadline):
+            pass
+
+    # Same as load(), but yields the data for each toon as soon as it has
+    # finished loading, in whatever order the toons finish. Every toon's
+    # entry is added to data before the first one is yielded, in the same
+    # order as toonlist, and groupstats is complete once the generator is
+    # exhausted.
+    def iter_load(self, realm, frealm, toonlist, data, groupstats, refdata=None, deadline=None):
 
-        classes = ClassEntry.get_mapping()
-        oauth_headers = get_oauth_headers()
+        start = time.time()
+        self.late = 0
 
-        session = FuturesSession(max_workers=10)
-        futures = []
+        if refdata is None:
+            refdata = get_reference_data()
+        classes = refdata.class_names
+        self.client = get_client()
+        oauth_headers = self.client.oauth_headers()
 
         # Request all of the toon data from the blizzard API and determine the
         # group's ilvls, armor type counts and token type counts.  subs are not
         # included in the counts, since they're not really part of the main
-        # group. The Blizzard API has a limit of 100 calls per second. Keep a
-        # count and if we hit 100 calls, we'll wait a half second before
-        # continuing. If someone has more than 100 toons in their list, they
-        # should be slapped.
-        toon_count = 0
+        # group. The Blizzard API has a limit of 100 calls per second, which
+        # the rate limiter enforces for every request the workers make.
+        toon_requests = []
         for toon in toonlist:
             toonname = toon.name
             toonrealm = toon.realm
             if toonrealm == realm:
                 toonfrealm = frealm
             else:
-                toonfrealm = Realm.query_realm(toonrealm)
+                toonfrealm = refdata.realm_names.get(toonrealm, '')
 
-            # TODO: this object can probably be a class instead of another dict
-            newdata = dict()
+            newdata = CharacterSnapshot(toonname, toonrealm, toonfrealm, toon.status, toon.role)
             data.append(newdata)
 
-            # a realm is received in the json data from the API, but we need to
-            # pass the normalized value to the next stages.  ignore this field
-            # from the data.
-            newdata['toonrealm'] = toonrealm
-            newdata['toonfrealm'] = toonfrealm
-            newdata['status'] = toon.status
-            newdata['role'] = toon.role
-
-            quoted_name = urllib.parse.quote(toonname.encode('utf-8').lower())
-            url = f'https://us.api.blizzard.com/profile/wow/character/{toonrealm}/{quoted_name}?namespace=profile-us&locale=en_US'
+            toon_requests.append((character_url(toonrealm, toonname), newdata))
+
+        # Load the cached responses for every toon at once so that the
+        # requests can be made conditional.
+        cache = CharacterCache([x[0] for x in toon_requests])
+
+        # Toons that Blizzard recently said don't exist aren't requested
+        # again. Their error rows can be shown right away.
+        missing = [x for x in toon_requests if x[0] in cache.missing]
+        toon_requests = [x for x in toon_requests if x[0] not in cache.missing]
+        for url, newdata in missing:
+            status, jsondata = cache.missing[url]
+            reason = ('Got a %d requesting profile from Battle.net for toon %s recently, so it was not '
+                      'requested again. Fix the toon in the editor, or save the group to check again.'
+                      % (status, newdata.name))
+            if 'detail' in jsondata:
+                reason += ' (reason: %s)' % jsondata['detail']
+            newdata.fail(reason, missing=True)
+            yield newdata
+
+        # Toons that are already being loaded for another page view on this
+        # instance wait for that load instead of starting their own. The
+        # rest are marked as in flight, so later page views can do the same
+        # with them. waiting maps each future to the toons waiting on it.
+        new_requests = []
+        waiting = {}
+        urls = {}
+        with _inflight_lock:
+            for url, newdata in toon_requests:
+                future = _inflight.get(url)
+                if future is None:
+                    future = _inflight[url] = Future()
+                    new_requests.append((url, newdata, future))
+                waiting.setdefault(future, []).append(newdata)
+                urls[future] = url
+
+        if len(new_requests) < len(toon_requests):
+            logging.info('sharing %d toon loads with other page views' % (len(toon_requests) - len(new_requests)))
+
+        # Each toon needs a profile and an equipment request. Count them
+        # against the limits shared with the other instances before handing
+        # them off to the workers, which do any waiting that's needed.
+        delay = ratelimit.limiter.claim_shared(2 * len(new_requests))
+        if delay > 0:
+            logging.warning(f'Rate limited: requests for this group will wait up to {delay:.2f} seconds')
+
+        timer = metrics.current()
+        for url, newdata, future in new_requests:
 
             # create the rpc object for the fetch method.  the deadline
             # defaults to 5 seconds, but that seems to be too short for the
             # Blizzard API site sometimes.  setting it to 10 helps a little
             # but it makes page loads a little slower.
-            future = session.get(url, headers=oauth_headers)
-            future.toonname = toonname
-            future.toondata = newdata
-            futures.append(future)
-
-            # This really shouldn't happen, but pause a half-second every
-            # hundred toons so that we don't blow through the API quota.
-            toon_count = toon_count + 1
-            if toon_count > 100:
-                time.sleep(0.5)
-                toon_count = 0
+            self.start_fetch(cache, url, oauth_headers, newdata.name, timer, future)
 
         # Now that all of the RPC calls have been created, loop through the data
         # dictionary one more time and wait for each fetch to be completed. Once
         # all of the waits finish, then we have all of the data from the
         # Blizzard API and can loop through all of it and build the page.
-        start = time.time()
-        for future in as_completed(futures):
-            resp = future.result()
-            self.handle_result(resp, future.toonname, future.toondata,
-                               groupstats, classes)
-        end = time.time()
-        logging.info(f"Time spent retrieving data: {end-start} seconds")
+        fetch_start = time.time()
+        timeout = None
+        if deadline is not None:
+            timeout = max(0, start + deadline - fetch_start)
 
-    # Callback that handles the result of the call to the Blizzard API.  This will fill in
-    # the toondata dict for the requested toon with either data from Battle.net or with an
-    # error message to display on the page.
-    def handle_result(self, response, name, toondata, groupstats, classes):
+        pending = set(waiting)
+        try:
+            for future in as_completed(waiting, timeout=timeout):
+                pending.discard(future)
+                for toondata in waiting[future]:
+                    self.finish(cache, urls[future], future.result(), toondata, groupstats, classes)
+                    yield toondata
+        except TimeoutError:
+            pass
+
+        # Whatever is still loading at the deadline is shown from its last
+        # good data. The loads carry on, and their results are saved once they
+        # finish.
+        for future in pending:
+            for toondata in waiting[future]:
+                self.late += 1
+                last_good = cache.last_good.get(urls[future])
+                if last_good is not None:
+                    self.restore(last_good, toondata, groupstats)
+                else:
+                    toondata.fail(f'Battle.net did not respond in time for {toondata.name}. Refresh page to try again.')
+                yield toondata
+        end = time.time()
 
-        toondata['name'] = name
-        toondata['load_status'] = 'ok'
+        if pending:
+            logging.warning(f'{self.late} toons were not loaded within {deadline} seconds')
+            save_late_results(cache, dict((future, urls[future]) for future in pending))
+
+        cache.save()
+        timer.add('fetch', end - fetch_start, count=len(new_requests))
+
+        # Count any retries and hedges against the shared limits too
+        extra = self.client.take_extra_calls()
+        if extra:
+            ratelimit.limiter.claim_shared(extra)
+
+        logging.info(f"Time spent retrieving data: {end-fetch_start} seconds")
+
+    # Returns whether the result of a load has everything needed to show the
+    # toon.
+    @staticmethod
+    def is_complete(result):
+        response, profile, equipment, items = result
+        return (not isinstance(response, Exception) and response.status_code == 200 and
+                isinstance(profile, dict) and 'equipment_href' in profile and
+                not isinstance(equipment, Exception) and equipment is not None and
+                equipment.status_code == 200 and isinstance(items, list))
+
+    # Fills in a toon from the result of its load. A complete result becomes
+    # the toon's last good data. If the load failed for any reason other than
+    # the toon not existing, the last good data is shown instead of an error
+    # when there is any.
+    def finish(self, cache, url, result, toondata, groupstats, classes):
+        if Importer.is_complete(result):
+            cache.remember(url, result[1], result[3])
+        else:
+            response = result[0]
+            missing = (not isinstance(response, Exception) and
+                       response.status_code in CharacterCache.MISSING_STATUSES)
+            last_good = cache.last_good.get(url)
+            if last_good is not None and not missing:
+                logging.info('showing the last good data for %s' % toondata.name.encode('ascii', 'ignore'))
+                self.restore(last_good, toondata, groupstats)
+                return
+
+        self.handle_result(*result, toondata, groupstats, classes)
+
+    def restore(self, last_good, toondata, groupstats):
+        toondata.restore(last_good['profile'], last_good['items'], last_good['time'])
+        Importer.add_stats(toondata, groupstats)
+
+    # Loads a toon with fetch_character and passes the result on to shared,
+    # which page views other than this one may be waiting on as well. The
+    # toon stops being in flight before the result is set, so a page view
+    # that comes along later starts a new load.
+    def start_fetch(self, cache, url, headers, name, timer, shared):
+
+        def finished(result):
+            with _inflight_lock:
+                if _inflight.get(url) is shared:
+                    del _inflight[url]
+            shared.set_result(result)
 
-        # change the json from the response into a dict of data.
         try:
-            jsondata = response.json()
+            future = self.fetch_character(cache, url, headers, name, timer)
         except Exception as e:
-            toondata['load_status'] = 'nok'
-            toondata['reason'] = 'Failed to parse data from Blizzard. Refresh page to try again.'
-            logging.exception('Failed to parse response as json: %s' % response.content)
+            finished((e, None, None, None))
+            return
+        future.add_done_callback(lambda f: finished(f.result()))
+
+    # Requests the profile for a toon and, as soon as it arrives, queues the
+    # equipment request for it on the same workers. This way the equipment
+    # requests overlap with each other and with any profile requests that are
+    # still in flight, instead of running one at a time once all of the
+    # profiles are back. The returned future resolves to a tuple of the
+    # profile response (or the exception raised fetching it), the parsed
+    # profile, the equipment response (or exception, or None if there was
+    # nothing to request), and the parsed list of items. The raw json is
+    # dropped as soon as it's parsed. Both requests are made conditional on
+    # the toon's entry in the cache, and both are timed with timer.
+    def fetch_character(self, cache, url, headers, name, timer):
+        result = Future()
+
+        def equipment_done(equip_future, profile, jsondata):
+            try:
+                equipment = equip_future.result()
+            except Exception as e:
+                timer.fetch('equipment', name, e)
+                result.set_result((profile, jsondata, e, None))
+                return
+
+            timer.fetch('equipment', name, equipment)
+            try:
+                with timer.phase('classify'):
+                    equipdata = cache.parse(url, 'equipment', equipment, parse_equipment)
+            except Exception as e:
+                result.set_result((profile, jsondata, e, None))
+                return
+            result.set_result((profile, jsondata, equipment, equipdata))
+
+        def profile_done(profile_future):
+            try:
+                profile = profile_future.result()
+            except Exception as e:
+                timer.fetch('profile', name, e)
+                result.set_result((e, None, None, None))
+                return
+
+            timer.fetch('profile', name, profile)
+            try:
+                with timer.phase('classify'):
+                    jsondata = cache.parse(url, 'profile', profile, parse_profile)
+            except Exception:
+                result.set_result((profile, None, None, None))
+                return
+
+            href = jsondata.get('equipment_href') if isinstance(jsondata, dict) else None
+            if profile.status_code != 200 or not href:
+                result.set_result((profile, jsondata, None, None))
+                return
+
+            try:
+                equip_future = self.client.submit(f'{href}&locale=en_US',
+                                           cache.request_headers(url, 'equipment', headers))
+            except Exception as e:
+                result.set_result((profile, jsondata, e, None))
+                return
+            equip_future.add_done_callback(
+                lambda f: equipment_done(f, profile, jsondata))
+
+        self.client.submit(url, cache.request_headers(url, 'profile', headers)).add_done_callback(profile_done)
+        return result
+
+    # Handles the results of the calls to the Blizzard API for a toon.  This will fill in
+    # the CharacterSnapshot for the requested toon with either data from Battle.net or with an
+    # error message to display on the page.
+    def handle_result(self, response, profile, equipment, items, toondata, groupstats, classes):
+
+        if isinstance(response, Exception):
+            self.handle_request_exception(response, 'profile', toondata)
+            return
+
+        # the json from the response was already parsed when the profile
+        # arrived. if that failed, there's nothing to display.
+        if profile is None:
+            toondata.fail('Failed to parse data from Blizzard. Refresh page to try again.')
+            logging.error('Failed to parse response as json: %s' % response.content)
             return
 
         # Catch HTTP errors from Blizzard. 404s really wreck everything.
-        if not self.check_response_status(response, jsondata, 'profile', toondata):
+        if not self.check_response_status(response, profile, 'profile', toondata):
             return;
 
         # store off some of the fields that we care about directly
-        toondata['guild'] = jsondata.get('guild', {})
-        toondata['realm'] = jsondata['realm']
-        toondata['character_class'] = jsondata['character_class']
-        toondata['name'] = jsondata['name']
-        toondata['average_item_level'] = jsondata['average_item_level']
-        toondata['equipped_item_level'] = jsondata['equipped_item_level']
-        toondata['covenant'] = jsondata.get('covenant_progress',{}).get('chosen_covenant',{}).get('name','None')
+        toondata.set_profile(profile)
 
-        logging.info("got good results for %s" % name.encode('ascii', 'ignore'))
+        logging.info("got good results for %s" % toondata.name.encode('ascii', 'ignore'))
 
         # For each toon, update the statistics for the group as a whole
-        if toondata['status'] == 'main':
-            groupstats['ilvlmains'] += 1
-            groupstats['totalilvl'] += jsondata['average_item_level']
-            groupstats['totalilvleq'] += jsondata['equipped_item_level']
-
-            toonclass = jsondata['character_class']['name']
-            logging.info("%s" % toonclass)
-            groupstats[Importer.CLASS_ARMOR.get(toonclass, '')] += 1
-
-            if toondata['role'] == 'dps':
-                groupstats['melee'] += 1
-            elif toondata['role'] == 'ranged':
-                groupstats['ranged'] += 1
-            elif toondata['role'] == 'tank':
-                groupstats['tanks'] += 1
-            elif toondata['role'] == 'healer':
-                groupstats['healers'] += 1
-
-        # We're also going to need the equipment for this character so make a second request
-        oauth_headers = get_oauth_headers()
-        try:
-            equip_res = requests.get(f"{jsondata['equipment']['href']}&locale=en_US",
-                                     headers=oauth_headers)
-        except Exception as e:
-            self.handle_request_exception(e, 'equipment', toondata)
-            return
+        Importer.add_stats(toondata, groupstats)
 
-        # change the json from the response into a dict of data.
-        jsondata = equip_res.json()
+        # The equipment request was made as soon as the profile arrived. If
+        # there's no response for it, the grid reports the missing data.
+        if isinstance(equipment, Exception):
+            self.handle_request_exception(equipment, 'equipment', toondata)
+            return
+        elif equipment is None:
+            return
 
         # Catch HTTP errors from Blizzard. 404s really wreck everything.
-        if not self.check_response_status(equip_res, jsondata, 'equipment', toondata):
+        if not self.check_response_status(equipment, items, 'equipment', toondata):
             return;
 
-        toondata['equipped_items'] = jsondata.get('equipped_items', [])
-
-        # Group all gems together into a comma-separated list for tooltipParams
-        for item in toondata['equipped_items']:
-            if not isinstance(item, dict):
-                continue
-
-            item['tooltips'] = {}
-            if 'sockets' in item:
-                gems = []
-                for socket in item['sockets']:
-                    gems.append(socket.get('item', {}).get('id', 0))
+        toondata.set_items(items)
 
-                if gems:
-                    item['tooltips']['gems'] = ':'.join(str(x) for x in gems)
-
-            # Default enchant checking to -1 for all items
-            item['enchant'] = -1
+    # Adds a toon whose profile loaded to the statistics for its group. subs
+    # aren't counted.
+    @staticmethod
+    def add_stats(toondata, groupstats):
+        if toondata.status != 'main' or toondata.character_class is None:
+            return
 
-            slot = item['slot']['type']
-            if slot in Importer.ENCHANTS:
-                if slot != 'OFF_HAND' or 'weapon' in item:
-                    item['enchant'] = 0
-                    for enchant in item.get('enchantments', []):
+        groupstats['ilvlmains'] += 1
+        groupstats['totalilvl'] += toondata.average_item_level
+        groupstats['totalilvleq'] += toondata.equipped_item_level
 
-                        # Skip non-permanent enchants
-                        if enchant.get('enchantment_slot', {}).get('id', -1) != 0:
-                            continue
+        toonclass = toondata.character_class
+        logging.info("%s" % toonclass)
+        groupstats[Importer.CLASS_ARMOR.get(toonclass, '')] += 1
 
-                        enchant_id = enchant.get('enchantment_id', 0)
-                        item['tooltips']['enchant'] = enchant_id
-                        if enchant_id in Importer.BETTER_ENCHANTS[slot] and item['enchant'] < 2:
-                            item['enchant'] = 2
-                        elif enchant_id in Importer.ENCHANTS[slot] and item['enchant'] < 1:
-                            item['enchant'] = 1
+        if toondata.role == 'dps':
+            groupstats['melee'] += 1
+        elif toondata.role == 'ranged':
+            groupstats['ranged'] += 1
+        elif toondata.role == 'tank':
+            groupstats['tanks'] += 1
+        elif toondata.role == 'healer':
+            groupstats['healers'] += 1
 
     # Handles exceptions from requests to the API in a common fashion
     def handle_request_exception(self, exception, where, toondata):
-        toondata['load_status'] = 'nok'
+        name = toondata.name
 
         if isinstance(exception, requests.Timeout):
             logging.error('request timed out on toon %s' % name.encode('ascii', 'ignore'))
-            toondata['reason'] = f'Timeout retrieving {where} data from Battle.net for {name}. Refresh page to try again.'
+            toondata.fail(f'Timeout retrieving {where} data from Battle.net for {name}. Refresh page to try again.')
         elif isinstance(exception, requests.ConnectionError):
             logging.error('request failed to connect for %s' % name.encode('ascii', 'ignore'))
-            toondata['reason'] = f'Failed to connect to Battle.net when retrieving {where} for toon {name}'
+            toondata.fail(f'Failed to connect to Battle.net when retrieving {where} for toon {name}')
         else:
             logging.error('request threw unknown exception on toon %s' % name.encode('ascii', 'ignore'))
-            toondata['reason'] = f'Unknown error retrieving {where} data from Battle.net for toon {name}.  Refresh page to try again.'
+            toondata.fail(f'Unknown error retrieving {where} data from Battle.net for toon {name}.  Refresh page to try again.')
 
     # Checks response codes and error messages from the API in a common fashion.
     def check_response_status(self, response, jsondata, where, toondata):
         if response.status_code != 200 or ( 'code' in jsondata and 'detail' in jsondata ):
             code = jsondata.get('code', response.status_code)
-            logging.error('request returned a %d status code on toon %s' % (code, toondata['name'].encode('ascii', 'ignore')))
-            toondata['load_status'] = 'nok'
-            toondata['reason'] = 'Got a %d requesting %s from Battle.net for toon %s.  Refresh page to try again.' % (code, where, toondata['name'])
+            logging.error('request returned a %d status code on toon %s' % (code, toondata.name.encode('ascii', 'ignore')))
+            reason = 'Got a %d requesting %s from Battle.net for toon %s.  Refresh page to try again.' % (code, where, toondata.name)
 
             if 'detail' in jsondata:
-                toondata['reason'] += ' (reason: %s)' % jsondata['detail']
+                reason += ' (reason: %s)' % jsondata['detail']
+
+            toondata.fail(reason, missing=(where == 'profile' and
+                                           response.status_code in CharacterCache.MISSING_STATUSES))
 
             return False
 
@@ -513,58 +1064,97 @@ class Importer(object):
 
 
 class Setup(object):
+
+    # The most entities written or deleted in one datastore call
+    BATCH_SIZE = 500
+
     # Loads the list of realms into the datastore from the blizzard API so that
     # the realm list on the front page gets populated.  Also loads the list of
     # classes into a table on the DB so that we don't have to request it
     def initdb(self, app):
         try:
-            oauth_headers = get_oauth_headers()
+            self.client = get_client()
+            oauth_headers = self.client.oauth_headers()
+            ratelimit.limiter.claim_shared(2)
             realmcount = self.init_realms(oauth_headers)
             classcount = self.init_classes(oauth_headers)
+
+            # Tell every instance to reload its copy of the realm and class
+            # lists.
+            ReferenceData.bump()
             return [realmcount, classcount]
         except Exception as e:
             logging.exception('')
             return [0, 0]
 
     def init_realms(self, oauth_headers):
-        # Delete all of the entities out of the realm datastore so fresh
-        # entities can be loaded.
-        query = Realm.query()
-        for row in query.fetch():
-            row.key.delete()
-
-        # retrieve a list of realms from the blizzard API
+        # retrieve a list of realms from the blizzard API. If that fails, the
+        # realms already in the datastore are left alone.
         url = 'https://us.api.blizzard.com/data/wow/realm/index?namespace=dynamic-us&locale=en_US&region=us'
-        response = requests.get(url, headers=oauth_headers)
-        if response.status_code == 200:
-            jsondata = response.json()
-        else:
-            jsondata = {'realms': []}
+        response = self.client.get(url, oauth_headers)
+        if response.status_code != 200:
+            logging.error('failed to load the realm index: %d' % response.status_code)
+            return 0
 
-        for realm in jsondata['realms']:
-            new_realm = Realm(realm=realm['name'], slug=realm['slug'],
-                              namespace='Realms', id=realm['slug'])
-            new_realm.put()
+        jsondata = response.json()
+        wanted = dict((realm['slug'], Realm(realm=realm['name'], slug=realm['slug'],
+                                            namespace='Realms', id=realm['slug']))
+                      for realm in jsondata['realms'])
 
-        return len(jsondata['realms'])
+        self.sync('realm', Realm.query(namespace='Realms').fetch(), wanted, 'slug', ['realm'])
+        return len(wanted)
 
     def init_classes(self, oauth_headers):
-        # Delete all of the entities out of the class datastore so fresh
-        # entities can be loaded.
-        query = ClassEntry.query()
-        for row in query.fetch():
-            row.key.delete()
-
-        # retrieve a list of classes from the blizzard API
+        # retrieve a list of classes from the blizzard API. If that fails, the
+        # classes already in the datastore are left alone.
         url = 'https://us.api.blizzard.com/data/wow/playable-class/index?namespace=static-us&locale=en_US&region=us'
-        response = requests.get(url, headers=oauth_headers)
-        if response.status_code == 200:
-            jsondata = response.json()
-        else:
-            jsondata = {'classes': []}
-
-        for cls in jsondata['classes']:
-            class_entry = ClassEntry(classId=cls['id'], name=cls['name'])
-            class_entry.put()
-
-        return len(jsondata['classes'])
+        response = self.client.get(url, oauth_headers)
+        if response.status_code != 200:
+            logging.error('failed to load the class index: %d' % response.status_code)
+            return 0
+
+        jsondata = response.json()
+        wanted = dict((cls['id'], ClassEntry(classId=cls['id'], name=cls['name'], id=cls['id']))
+                      for cls in jsondata['classes'])
+
+        self.sync('class', ClassEntry.query().fetch(), wanted, 'classId', ['name'])
+        return len(wanted)
+
+    # Brings the entities in the datastore in line with the ones that should
+    # be there. Entities are matched up by the key property, and only the
+    # ones that were added, had one of the fields change, or went away are
+    # written, in batches. New and changed entities are written before any
+    # are deleted, and nothing is ever missing in between, so the lists can
+    # still be read while this runs.
+    def sync(self, kind, entities, wanted, key, fields):
+        existing = {}
+        deletes = []
+        for entity in entities:
+            # Older versions of the sync could leave duplicates behind
+            if getattr(entity, key) in existing:
+                deletes.append(entity.key)
+            else:
+                existing[getattr(entity, key)] = entity
+
+        puts = []
+        added = 0
+        updated = 0
+        for k, entity in wanted.items():
+            current = existing.pop(k, None)
+            if current is None:
+                puts.append(entity)
+                added += 1
+            elif any(getattr(current, f) != getattr(entity, f) for f in fields):
+                for f in fields:
+                    setattr(current, f, getattr(entity, f))
+                puts.append(current)
+                updated += 1
+
+        deletes.extend(entity.key for entity in existing.values())
+
+        for i in range(0, len(puts), Setup.BATCH_SIZE):
+            ndb.put_multi(puts[i:i + Setup.BATCH_SIZE])
+        for i in range(0, len(deletes), Setup.BATCH_SIZE):
+            ndb.delete_multi(deletes[i:i + Setup.BATCH_SIZE])
+
+        logging.info('%s sync: %d added, %d updated, %d removed' % (kind, added, updated, len(deletes)))